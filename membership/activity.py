@@ -0,0 +1,107 @@
+import atexit
+import threading
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from .models import User
+
+
+class ActivityTracker:
+    """
+    Buffers ``last_login`` and ``last_seen`` timestamps per user id and
+    writes them with one bulk UPDATE per ``batch_size`` users, either every
+    ``flush_interval`` seconds or as soon as ``max_entries`` users are
+    pending, from a background thread started on first use. Pending
+    timestamps are also flushed at interpreter exit. A ``flush_interval``
+    of ``None`` disables the thread, leaving flushing to the caller.
+    """
+
+    def __init__(self, flush_interval=10, max_entries=1000, batch_size=500):
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        # user id -> [last_login or None, last_seen]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record_login(self, user_id, when=None):
+        self._record(user_id, when or timezone.now(), login=True)
+
+    def record_seen(self, user_id, when=None):
+        self._record(user_id, when or timezone.now(), login=False)
+
+    def _record(self, user_id, when, login):
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                entry = self._pending[user_id] = [None, when]
+            elif when > entry[1]:
+                entry[1] = when
+            if login:
+                entry[0] = when
+            full = len(self._pending) >= self.max_entries
+        if self.flush_interval is not None:
+            self._start()
+            if full:
+                self._wake.set()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_forever, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except DatabaseError:
+                pass
+
+    def flush(self):
+        """Write all pending timestamps. Returns the number of users updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        try:
+            for i in range(0, len(items), self.batch_size):
+                self._write(items[i:i + self.batch_size])
+        except DatabaseError:
+            # Put the unwritten timestamps back for the next attempt, keeping
+            # any recorded in the meantime since those are newer.
+            with self._lock:
+                for user_id, entry in items[i:]:
+                    current = self._pending.setdefault(user_id, entry)
+                    if current is not entry and current[0] is None:
+                        current[0] = entry[0]
+            raise
+        return len(items)
+
+    def _write(self, chunk):
+        updates = {"last_seen": Case(
+            *(When(pk=user_id, then=Value(seen)) for user_id, (login, seen) in chunk),
+            default=F("last_seen"),
+        )}
+        logins = [When(pk=user_id, then=Value(login)) for user_id, (login, seen) in chunk if login]
+        if logins:
+            updates["last_login"] = Case(*logins, default=F("last_login"))
+        User.objects.filter(pk__in=[user_id for user_id, _ in chunk]).update(**updates)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+
+activity_tracker = ActivityTracker(
+    flush_interval=getattr(settings, "MEMBERSHIP_ACTIVITY_FLUSH_INTERVAL", 10),
+    max_entries=getattr(settings, "MEMBERSHIP_ACTIVITY_MAX_ENTRIES", 1000),
+)
@@ -1,11 +1,12 @@
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib import admin
 from django.contrib.auth import password_validation
 from django.contrib.auth.models import Group
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.translation import gettext_lazy as _
-from .models import User, EmailTemplate
+from .models import User, EmailTemplate, PasswordResetRequest
 
 
 admin.site.unregister(Group)
@@ -94,13 +95,23 @@ class UserCreationForm(forms.ModelForm):
             if hasattr(self, "save_m2m"):
                 self.save_m2m()
         if self.cleaned_data["send_welcome_email"]:
-            user.send_welcome_email(raw_password)
+            if commit:
+                user.send_welcome_email(raw_password)
+            else:
+                # The outbox row references the user, queue it once the
+                # caller has saved the user and calls save_m2m().
+                save_m2m = self.save_m2m
+
+                def save_m2m_and_send_welcome_email():
+                    save_m2m()
+                    user.send_welcome_email(raw_password)
+                self.save_m2m = save_m2m_and_send_welcome_email
         return user
 
 
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
-    list_display = BaseUserAdmin.list_display + ('last_login',)
+    list_display = BaseUserAdmin.list_display + ('last_login', 'last_seen')
     fieldsets = BaseUserAdmin.fieldsets
     add_form = UserCreationForm
     add_fieldsets = (
@@ -119,11 +130,18 @@ class UserAdmin(BaseUserAdmin):
 
     @admin.action(description='Reset user password.')
     def reset_password(self, request, queryset):
-        for user in queryset:
-            password = User.objects.generate_password()
-            user.set_password(password)
-            user.send_welcome_email(password)
-            user.save()
+        threshold = getattr(settings, "MEMBERSHIP_RESET_PASSWORD_BACKGROUND_THRESHOLD", 200)
+        ids = list(queryset.order_by("pk").values_list("pk", flat=True))
+        if len(ids) > threshold:
+            PasswordResetRequest.objects.bulk_create(
+                [PasswordResetRequest(user_id=pk) for pk in ids], batch_size=1000, ignore_conflicts=True
+            )
+            self.message_user(
+                request, f"Queued password resets of {len(ids)} users for the reset_passwords worker."
+            )
+        else:
+            User.objects.reset_passwords(User.objects.filter(pk__in=ids).order_by("pk"))
+            self.message_user(request, f"Reset passwords of {len(ids)} users.")
 
     actions = ['reset_password']
 
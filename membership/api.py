@@ -1,10 +1,35 @@
-from django.contrib import auth
-from ninja import NinjaAPI, Schema
-from ninja.errors import ValidationError
-from .auth import BearerAuthNinja, create_token
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from typing import List, Optional
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+from ninja import NinjaAPI, Query, Schema
+from ninja.errors import HttpError, ValidationError
+from .activity import activity_tracker
+from .auth import (
+    AsyncBearerAuthNinja, aauthenticate, acreate_refresh_token, arotate_refresh_token, create_token
+)
+from .conditional import user_etag
+from .hashers import HashingPoolSaturated
+from .keys import get_key_set
+from .metrics import instrument, registry
+from .models import User
 
 
-api = NinjaAPI(auth=BearerAuthNinja(), urls_namespace="membership")
+api = NinjaAPI(auth=AsyncBearerAuthNinja(), urls_namespace="membership")
+
+
+@api.exception_handler(HashingPoolSaturated)
+def hashing_pool_saturated(request, exc):
+    response = api.create_response(
+        request, {"detail": "Too many login attempts in progress, retry shortly."}, status=503
+    )
+    response["Retry-After"] = "1"
+    return response
 
 
 class LoginDetails(Schema):
@@ -14,18 +39,30 @@ class LoginDetails(Schema):
 
 class TokenResponse(Schema):
     token: str
+    refresh_token: str
+
+
+class RefreshDetails(Schema):
+    refresh_token: str
 
 
 @api.post("/login", auth=None, response=TokenResponse)
-def login(request, form: LoginDetails):
-    user = auth.authenticate(
-        request=request,
-        username=form.username,
-        password=form.password
-    )
-    if not user or not user.is_active:
+@instrument("login")
+async def login(request, form: LoginDetails):
+    user = await aauthenticate(form.username, form.password)
+    if not user:
         raise ValidationError([{"msg": "Invalid credentials."}])
-    return {"token": create_token(user)}
+    activity_tracker.record_login(user.pk)
+    return {"token": create_token(user), "refresh_token": await acreate_refresh_token(user)}
+
+
+@api.post("/refresh", auth=None, response=TokenResponse)
+async def refresh(request, form: RefreshDetails):
+    rotated = await arotate_refresh_token(form.refresh_token)
+    if rotated is None:
+        raise ValidationError([{"msg": "Invalid refresh token."}])
+    user, refresh_token = rotated
+    return {"token": create_token(user), "refresh_token": refresh_token}
 
 
 class UserDetailsResponse(Schema):
@@ -33,5 +70,78 @@ class UserDetailsResponse(Schema):
 
 
 @api.get("/account", response=UserDetailsResponse)
-def account_view(request):
+@user_etag
+async def account_view(request):
     return request.user
+
+
+class UserListItem(Schema):
+    id: int
+    username: str
+    email: str
+    is_active: bool
+    date_joined: datetime
+
+
+class UserListResponse(Schema):
+    items: List[UserListItem]
+    next_cursor: Optional[str]
+
+
+def encode_cursor(row):
+    return urlsafe_b64encode(json.dumps([row["date_joined"].isoformat(), row["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date_joined, user_id = json.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(date_joined), int(user_id)
+    except (BinasciiError, ValueError, TypeError):
+        raise ValidationError([{"msg": "Invalid cursor."}])
+
+
+@api.get("/users", response=UserListResponse)
+async def list_users(
+    request, search: str = "", cursor: Optional[str] = None, limit: int = Query(50, ge=1, le=200)
+):
+    """
+    List users ordered by ``(date_joined, id)``, optionally narrowed to a
+    username or email prefix. Pages are fetched by keyset: ``cursor`` is the
+    ``next_cursor`` of the previous page, so every page is an index seek.
+    """
+    if not request.user.is_staff:
+        raise HttpError(403, "Staff only.")
+    users = User.objects.search(search).order_by("date_joined", "id")
+    if cursor:
+        date_joined, user_id = decode_cursor(cursor)
+        # The redundant date_joined__gte gives the planner a range to seek to.
+        users = users.filter(date_joined__gte=date_joined).filter(
+            Q(date_joined__gt=date_joined) | Q(date_joined=date_joined, id__gt=user_id)
+        )
+    rows = [
+        row async for row in
+        users.values("id", "username", "email", "is_active", "date_joined")[:limit + 1]
+    ]
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return {"items": rows[:limit], "next_cursor": next_cursor}
+
+
+@api.get("/.well-known/jwks.json", auth=None)
+async def jwks(request, response: HttpResponse):
+    response["Cache-Control"] = f"public, max-age={getattr(settings, 'MEMBERSHIP_JWKS_MAX_AGE', 3600)}"
+    return get_key_set().jwks
+
+
+@api.get("/metrics", auth=None, include_in_schema=False)
+def metrics(request):
+    """
+    Prometheus scrape endpoint, enabled by ``MEMBERSHIP_METRICS``. When
+    ``MEMBERSHIP_METRICS_TOKEN`` is set, scrapers must send it as a bearer
+    token; leave it unset only when the path isn't reachable publicly.
+    """
+    if not registry.enabled:
+        raise Http404
+    token = getattr(settings, "MEMBERSHIP_METRICS_TOKEN", None)
+    if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        raise HttpError(401, "Unauthorized")
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
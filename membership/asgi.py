@@ -13,4 +13,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'membership.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from .verify import mount_token_verification  # noqa: E402 needs Django set up
+
+application = mount_token_verification(django_application)
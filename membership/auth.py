@@ -1,49 +1,408 @@
 import jwt
-from datetime import datetime, timedelta
+import asyncio
+import hmac
+import hashlib
+import secrets
+import time
+from copy import copy
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AnonymousUser, _user_has_module_perms, _user_has_perm
 from ninja.security import HttpBearer as BaseNinjaHttpBearer
+from .activity import activity_tracker
+from .cache import LRUCache, version_timeout
+from .hashers import hashing_executor, verify_password
+from .keys import get_key_set
+from .metrics import instrument
+from .connections import connection_registry
+from .models import RefreshToken
+from .revocation import revocation_list
 
 
 HS256 = "HS256"
+TOKEN_VERSION_KEY = "membership:token-version:{}"
 
+user_cache = LRUCache(
+    maxsize=getattr(settings, "MEMBERSHIP_USER_CACHE_SIZE", 1024),
+    ttl=getattr(settings, "MEMBERSHIP_USER_CACHE_TTL", 60),
+)
 
-def create_token(user):
+token_cache = LRUCache(
+    maxsize=getattr(settings, "MEMBERSHIP_TOKEN_CACHE_SIZE", 4096),
+)
+
+# user id -> task loading that user, shared by concurrent aget_user() calls
+_user_lookups = {}
+
+
+@instrument("create_token")
+def create_token(user, lifetime=None, extra_claims=None):
+    if lifetime is None:
+        lifetime = getattr(settings, "MEMBERSHIP_ACCESS_TOKEN_LIFETIME", timedelta(minutes=15))
     claims = {
         "id": user.id,
+        "jti": secrets.token_hex(16),
         "iat": datetime.utcnow(),
-        "exp": datetime.utcnow() + timedelta(days=30),
+        "exp": datetime.utcnow() + lifetime,
     }
+    if getattr(settings, "MEMBERSHIP_TOKEN_CLAIMS", False):
+        claims.update(user.get_token_claims())
+    if extra_claims:
+        claims.update(extra_claims)
+    key_set = get_key_set()
+    if key_set:
+        key = key_set.signing_key
+        return jwt.encode(
+            claims, key.private_key, algorithm=key.algorithm, headers={"kid": key.kid}
+        )
     return jwt.encode(
         claims, settings.SECRET_KEY, algorithm=HS256
     )
 
 
+def _refresh_token_digest(token):
+    return hmac.new(settings.SECRET_KEY.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+async def acreate_refresh_token(user):
+    token = secrets.token_urlsafe(32)
+    lifetime = getattr(settings, "MEMBERSHIP_REFRESH_TOKEN_LIFETIME", timedelta(days=30))
+    await RefreshToken.objects.acreate(
+        user=user, digest=_refresh_token_digest(token), expires_on=timezone.now() + lifetime
+    )
+    return token
+
+
+async def arotate_refresh_token(token):
+    """
+    Revoke refresh ``token`` and return its user with a new refresh token,
+    or ``None`` if the token is unknown, expired or revoked. Presenting an
+    already rotated token revokes every refresh token of its user, since
+    it means a copy of the token is in someone else's hands.
+    """
+    now = timezone.now()
+    refresh = await RefreshToken.objects.select_related("user").filter(
+        digest=_refresh_token_digest(token)
+    ).afirst()
+    if refresh is None or refresh.expires_on <= now or not refresh.user.is_active:
+        return None
+    if refresh.revoked_on is not None:
+        await RefreshToken.objects.filter(
+            user_id=refresh.user_id, revoked_on__isnull=True
+        ).aupdate(revoked_on=now)
+        return None
+    # Only one of several concurrent refreshes may claim the token.
+    if not await RefreshToken.objects.filter(pk=refresh.pk, revoked_on__isnull=True).aupdate(revoked_on=now):
+        return None
+    return refresh.user, await acreate_refresh_token(refresh.user)
+
+
+class RevokedTokenError(jwt.InvalidTokenError):
+    pass
+
+
+def _verify(token):
+    key_set = get_key_set()
+    if not key_set:
+        return jwt.decode(
+            token, settings.SECRET_KEY, algorithms=[HS256]
+        )
+    key = key_set.keys.get(jwt.get_unverified_header(token).get("kid"))
+    if key is None:
+        raise jwt.InvalidTokenError("Token was not signed with a known key.")
+    return jwt.decode(token, key.public_key, algorithms=[key.algorithm])
+
+
+def decode_token(token):
+    """
+    Verify ``token`` and return its claims, without checking revocation.
+    Verified claims are memoized in ``token_cache`` under a digest of the
+    token until the token expires, so a token that is presented repeatedly
+    is only verified once.
+    """
+    if isinstance(token, str):
+        token = token.encode()
+    key = hashlib.sha256(token).digest()
+    claims = token_cache.get(key)
+    if claims is None:
+        claims = _verify(token)
+        if "exp" in claims:
+            token_cache.set(key, claims, ttl=claims["exp"] - time.time())
+    return dict(claims)
+
+
+@instrument("read_claims")
+def read_claims(token):
+    """Verify ``token`` and return its claims, rejecting revoked tokens."""
+    claims = decode_token(token)
+    if "jti" in claims and revocation_list.is_revoked(claims["jti"]):
+        raise RevokedTokenError("Token has been revoked.")
+    return claims
+
+
+@instrument("read_claims")
+async def aread_claims(token):
+    """Async version of ``read_claims()``."""
+    claims = decode_token(token)
+    if "jti" in claims and await revocation_list.ais_revoked(claims["jti"]):
+        raise RevokedTokenError("Token has been revoked.")
+    return claims
+
+
+@instrument("read_token")
 def read_token(token):
-    claims = jwt.decode(
-        token, settings.SECRET_KEY, algorithms=[HS256]
+    return read_claims(token)["id"]
+
+
+def revoke_token(token):
+    """Revoke ``token`` until it expires."""
+    claims = decode_token(token)
+    revocation_list.revoke(
+        claims["jti"], datetime.fromtimestamp(claims["exp"], tz=dt_timezone.utc)
     )
-    return claims["id"]
+
+
+def _active_copy(user):
+    if user is None or not user.is_active:
+        return None
+    return copy(user)
+
+
+def get_user(user_id):
+    """
+    Return the active user with ``user_id`` or ``None``, consulting
+    ``user_cache`` before the database. Callers get their own copy so
+    that mutating it can't leak into other requests.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        user = get_user_model().objects.filter(id=user_id).first()
+        if user is not None:
+            user_cache.set(user_id, user)
+    return _active_copy(user)
+
+
+async def _load_user(user_id):
+    user = await get_user_model().objects.filter(id=user_id).afirst()
+    if user is not None:
+        user_cache.set(user_id, user)
+    return user
+
+
+async def aget_user(user_id):
+    """
+    Async version of ``get_user()``. Concurrent calls for the same user
+    that miss ``user_cache`` share a single database lookup.
+    """
+    user = user_cache.get(user_id)
+    if user is None:
+        lookup = _user_lookups.get(user_id)
+        if lookup is None or lookup.get_loop() is not asyncio.get_running_loop():
+            lookup = _user_lookups[user_id] = asyncio.ensure_future(_load_user(user_id))
+            lookup.add_done_callback(
+                lambda done: _user_lookups.pop(user_id, None) if _user_lookups.get(user_id) is done else None
+            )
+        user = await asyncio.shield(lookup)
+    return _active_copy(user)
+
+
+async def aauthenticate(username, password):
+    """
+    Async counterpart of ``ModelBackend.authenticate()``. The user is looked
+    up on the event loop and only the password hashing runs on the bounded
+    ``hashing_executor``, raising ``HashingPoolSaturated`` when it is full.
+    """
+    UserModel = get_user_model()
+    try:
+        user = await UserModel._default_manager.aget_by_natural_key(username)
+    except UserModel.DoesNotExist:
+        # Hash anyway so response times don't reveal which users exist.
+        await hashing_executor.run(make_password, password)
+        return None
+    is_correct, upgraded = await hashing_executor.run(verify_password, password, user.password)
+    if not is_correct or not user.is_active:
+        return None
+    if upgraded:
+        user.password = upgraded
+        await user.asave(update_fields=["password"])
+    return user
+
+
+class TokenUser:
+    """
+    Lightweight stand-in for the user model built from the claims of a
+    token issued in claims mode (``MEMBERSHIP_TOKEN_CLAIMS``). Permission
+    checks go through the authentication backends like for a real user.
+    """
+    __slots__ = ("id", "username", "is_active", "is_staff", "_perm_cache")
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, username, is_active, is_staff):
+        self.id = id
+        self.username = username
+        self.is_active = is_active
+        self.is_staff = is_staff
+
+    def __repr__(self):
+        return f"<TokenUser: {self.username}>"
+
+    @property
+    def pk(self):
+        return self.id
+
+    def has_perm(self, perm, obj=None):
+        return _user_has_perm(self, perm, obj)
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, app_label):
+        return _user_has_module_perms(self, app_label)
+
+    @classmethod
+    def from_claims(cls, claims):
+        return cls(
+            claims["id"], claims["username"], claims["is_active"], claims["is_staff"]
+        )
+
+
+def remember_token_version(user):
+    cache.set(TOKEN_VERSION_KEY.format(user.pk), user.token_version, version_timeout())
+
+
+def forget_token_version(user):
+    cache.delete(TOKEN_VERSION_KEY.format(user.pk))
+
+
+def resolve_user(claims):
+    """
+    Return the user for verified token ``claims``. Claims mode tokens whose
+    version matches the cached token version are answered without touching
+    the database, anything else falls back to ``get_user()``.
+    """
+    if "ver" not in claims:
+        return get_user(claims["id"])
+    version = cache.get(TOKEN_VERSION_KEY.format(claims["id"]))
+    if version == claims["ver"]:
+        return TokenUser.from_claims(claims) if claims["is_active"] else None
+    user = get_user(claims["id"])
+    if version is None and user is not None:
+        remember_token_version(user)
+    return user
+
+
+async def aresolve_user(claims):
+    """Async version of ``resolve_user()``."""
+    if "ver" not in claims:
+        return await aget_user(claims["id"])
+    version = await cache.aget(TOKEN_VERSION_KEY.format(claims["id"]))
+    if version == claims["ver"]:
+        return TokenUser.from_claims(claims) if claims["is_active"] else None
+    user = await aget_user(claims["id"])
+    if version is None and user is not None:
+        await cache.aset(
+            TOKEN_VERSION_KEY.format(user.pk), user.token_version, version_timeout()
+        )
+    return user
 
 
 class BearerAuthNinja(BaseNinjaHttpBearer):
+    @instrument("authenticate")
     def authenticate(self, request, token):
-        user_id = read_token(token)
-        request.user = get_user_model().objects.get(id=user_id)
+        try:
+            claims = read_claims(token)
+        except jwt.InvalidTokenError:
+            return None
+        user = resolve_user(claims)
+        if user is None:
+            return None
+        activity_tracker.record_seen(user.pk)
+        request.user = user
+        return True
+
+
+class AsyncBearerAuthNinja(BaseNinjaHttpBearer):
+    @instrument("authenticate")
+    async def authenticate(self, request, token):
+        try:
+            claims = await aread_claims(token)
+        except jwt.InvalidTokenError:
+            return None
+        user = await aresolve_user(claims)
+        if user is None:
+            return None
+        activity_tracker.record_seen(user.pk)
+        request.user = user
         return True
 
 
+class LazyChannelsUser:
+    """
+    ``scope["user"]`` of a bearer authenticated Channels connection. The
+    token is verified on connect but the user is only loaded when a
+    consumer awaits ``scope["user"].aget()``, after which attribute access
+    is delegated to it. The user id is available right away.
+    """
+    __slots__ = ("id", "claims", "_user")
+
+    is_anonymous = False
+
+    def __init__(self, claims):
+        self.id = claims["id"]
+        self.claims = claims
+        self._user = None
+
+    def __repr__(self):
+        return f"<LazyChannelsUser: {self.id}>"
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def is_authenticated(self):
+        return self._user is None or self._user.is_authenticated
+
+    async def aget(self):
+        if self._user is None:
+            self._user = await aresolve_user(self.claims) or AnonymousUser()
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith("_") or self._user is None:
+            raise AttributeError(
+                f"{name!r} isn't available until the user is loaded with `await scope['user'].aget()`."
+            )
+        return getattr(self._user, name)
+
+
 class BearerAuthChannelsMiddleware:
 
     def __init__(self, inner):
         self.inner = inner
 
     async def __call__(self, scope, receive, send):
+        connection = None
         if not scope["user"].is_authenticated:
-            for header in scope["headers"]:
-                if header[0] in (b"Authorization", b"authorization"):
-                    token = header[1][len('Bearer '):]
-                    user_id = read_token(token)
-                    scope["user"] = await get_user_model().objects.aget(id=user_id)
-                    break
-        return await self.inner(scope, receive, send)
+            headers = dict(scope["headers"])
+            authorization = headers.get(b"authorization") or headers.get(b"Authorization", b"")
+            if authorization[:7].lower() == b"bearer ":
+                try:
+                    claims = await aread_claims(authorization[7:])
+                except jwt.InvalidTokenError:
+                    claims = None
+                if claims is not None:
+                    scope["user"] = LazyChannelsUser(claims)
+                    if scope["type"] == "websocket":
+                        connection = connection_registry.register(claims["id"], claims.get("exp"), send)
+        try:
+            return await self.inner(scope, receive, send)
+        finally:
+            if connection is not None:
+                connection_registry.unregister(connection)
@@ -0,0 +1,102 @@
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from .cache import bump_versions, version_timeout
+
+
+USER_PERMISSION_VERSION_KEY = "membership:perm-version:user:{}"
+GROUP_PERMISSION_VERSION_KEY = "membership:perm-version:groups"
+PERMISSIONS_KEY = "membership:perms:{}"
+
+
+def bump_user_permission_versions(user_ids):
+    """Invalidate the cached permissions of the users with ``user_ids``."""
+    bump_versions(USER_PERMISSION_VERSION_KEY.format(pk) for pk in user_ids)
+
+
+def bump_group_permission_version():
+    """Invalidate the cached permissions of every user."""
+    bump_versions([GROUP_PERMISSION_VERSION_KEY])
+
+
+def _permissions_timeout():
+    return getattr(settings, "MEMBERSHIP_PERMISSION_CACHE_TIMEOUT", 3600)
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ``ModelBackend`` that keeps each user's permission set in the Django
+    cache across requests. Entries record the user and group permission
+    versions they were computed at and are fetched together with the
+    current versions in one ``get_many()``, so a steady-state ``has_perm()``
+    is a single cache read. Versions are bumped by the signal receivers
+    whenever user groups, user permissions or group permissions change.
+    Works with any object that has ``pk`` and ``is_active``, such as
+    ``TokenUser``; the user is only loaded from the database on a miss.
+
+    Without a shared cache backend other processes see a revocation only
+    once their versions expire, after ``version_timeout()`` seconds.
+    """
+
+    def _keys(self, user_obj):
+        return (
+            PERMISSIONS_KEY.format(user_obj.pk),
+            USER_PERMISSION_VERSION_KEY.format(user_obj.pk),
+            GROUP_PERMISSION_VERSION_KEY,
+        )
+
+    @staticmethod
+    def _cached(keys, values):
+        perms_key, user_key, group_key = keys
+        entry = values.get(perms_key)
+        versions = (values.get(user_key), values.get(group_key))
+        if entry is not None and None not in versions and entry[0] == versions:
+            return entry[1], versions
+        return None, versions
+
+    @staticmethod
+    def _missing_versions(keys, versions):
+        version = time.time_ns()
+        missing = {key: version for key, current in zip(keys[1:], versions) if current is None}
+        return missing, tuple(version if current is None else current for current in versions)
+
+    def _load_permissions(self, user_obj):
+        UserModel = get_user_model()
+        if not isinstance(user_obj, UserModel):
+            user_obj = UserModel._default_manager.get(pk=user_obj.pk)
+        return frozenset(
+            self.get_user_permissions(user_obj) | self.get_group_permissions(user_obj)
+        )
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, "_perm_cache"):
+            keys = self._keys(user_obj)
+            perms, versions = self._cached(keys, cache.get_many(keys))
+            if perms is None:
+                missing, versions = self._missing_versions(keys, versions)
+                if missing:
+                    cache.set_many(missing, version_timeout())
+                perms = self._load_permissions(user_obj)
+                cache.set(keys[0], (versions, perms), _permissions_timeout())
+            user_obj._perm_cache = perms
+        return user_obj._perm_cache
+
+    async def aget_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, "_perm_cache"):
+            keys = self._keys(user_obj)
+            perms, versions = self._cached(keys, await cache.aget_many(keys))
+            if perms is None:
+                missing, versions = self._missing_versions(keys, versions)
+                if missing:
+                    await cache.aset_many(missing, version_timeout())
+                perms = await sync_to_async(self._load_permissions)(user_obj)
+                await cache.aset(keys[0], (versions, perms), _permissions_timeout())
+            user_obj._perm_cache = perms
+        return user_obj._perm_cache
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from time import monotonic, time_ns
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe, process-local LRU cache with per-entry expiry.
+
+    A ``maxsize`` of 0 disables the cache: every lookup is a miss and
+    nothing is stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if not self.maxsize or (ttl is not None and ttl <= 0):
+            return
+        expires = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+def version_timeout():
+    """
+    Lifetime of the version keys that cached data is checked against, from
+    ``MEMBERSHIP_VERSION_TTL`` (default 300 seconds). Versions are bumped
+    in the Django cache of the process that made the change, so without a
+    shared ``CACHES`` backend (e.g. with locmem) other processes only see
+    the change once their own copy of the key expires.
+    """
+    return getattr(settings, "MEMBERSHIP_VERSION_TTL", 300)
+
+
+def bump_versions(keys):
+    """Set each of the version ``keys`` to a new version and return it."""
+    version = time_ns()
+    cache.set_many(dict.fromkeys(keys, version), version_timeout())
+    return version
@@ -0,0 +1,98 @@
+import time
+import asyncio
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+
+logger = logging.getLogger(__name__)
+
+# Application defined websocket close code (RFC 6455 reserves 4000-4999).
+CLOSE_UNAUTHORIZED = 4401
+
+
+class Connection:
+    __slots__ = ("user_id", "exp", "send")
+
+    def __init__(self, user_id, exp, send):
+        self.user_id = user_id
+        self.exp = exp
+        self.send = send
+
+
+class ConnectionRegistry:
+    """
+    Process-wide registry of bearer authenticated Channels connections.
+    While any are registered, a background task revalidates all of them
+    every ``interval`` seconds, loading the active users among them with
+    one ``id__in`` query per ``batch_size`` users, and closes connections
+    whose user was deactivated or deleted or whose token expired.
+    """
+
+    def __init__(self, interval=60, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._connections = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._connections)
+
+    def register(self, user_id, exp, send):
+        connection = Connection(user_id, exp, send)
+        self._connections.add(connection)
+        if self._task is None or self._task.get_loop() is not asyncio.get_running_loop():
+            self._task = asyncio.ensure_future(self._run())
+        return connection
+
+    def unregister(self, connection):
+        self._connections.discard(connection)
+
+    async def _run(self):
+        try:
+            while self._connections:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.revalidate()
+                except Exception:
+                    # Keep checking the remaining connections next time.
+                    logger.exception("Revalidating connections failed.")
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    async def revalidate(self):
+        """Close every registered connection that is no longer valid."""
+        now = time.time()
+        by_user = {}
+        for connection in list(self._connections):
+            by_user.setdefault(connection.user_id, []).append(connection)
+        user_ids = list(by_user)
+        active = set()
+        for i in range(0, len(user_ids), self.batch_size):
+            active.update([
+                user_id async for user_id in get_user_model().objects.filter(
+                    id__in=user_ids[i:i + self.batch_size], is_active=True
+                ).values_list("id", flat=True)
+            ])
+        closed = 0
+        for user_id, connections in by_user.items():
+            for connection in connections:
+                if user_id not in active or (connection.exp is not None and connection.exp <= now):
+                    await self.close(connection)
+                    closed += 1
+        return closed
+
+    async def close(self, connection):
+        self.unregister(connection)
+        try:
+            await connection.send({"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+        except Exception:
+            # The socket may have gone away since revalidate() listed it.
+            logger.warning("Closing connection of user %s failed.", connection.user_id, exc_info=True)
+
+
+connection_registry = ConnectionRegistry(
+    interval=getattr(settings, "MEMBERSHIP_CHANNELS_REVALIDATE_INTERVAL", 60),
+    batch_size=getattr(settings, "MEMBERSHIP_CHANNELS_REVALIDATE_BATCH_SIZE", 1000),
+)
@@ -0,0 +1,126 @@
+import os
+import asyncio
+import threading
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+
+
+@contextmanager
+def password_hashing_pool(workers=None):
+    """
+    Yield a process pool for ``hash_passwords()``, or ``None`` when a
+    single worker is requested and hashing should happen inline. The pool
+    size defaults to ``MEMBERSHIP_PASSWORD_HASHING_WORKERS`` or the CPU count.
+    """
+    if workers is None:
+        workers = getattr(settings, "MEMBERSHIP_PASSWORD_HASHING_WORKERS", None) or os.cpu_count() or 1
+    if workers <= 1:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield executor
+
+
+@contextmanager
+def password_hashing_threads(workers=None):
+    """
+    Like ``password_hashing_pool()`` but with a thread pool, which is safe to
+    start inside a web worker. ``hashlib`` releases the GIL while hashing,
+    so the threads still hash in parallel.
+    """
+    if workers is None:
+        workers = getattr(settings, "MEMBERSHIP_PASSWORD_HASHING_WORKERS", None) or os.cpu_count() or 1
+    if workers <= 1:
+        yield None
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="membership-reset") as executor:
+        yield executor
+
+
+def hash_passwords(passwords, executor=None):
+    """
+    Return ``make_password()`` of each of ``passwords``, in order, spreading
+    the work over ``executor`` when given. ``None`` passwords produce
+    unusable password hashes.
+    """
+    passwords = list(passwords)
+    if executor is None or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    chunksize = max(1, len(passwords) // ((os.cpu_count() or 1) * 4))
+    return list(executor.map(make_password, passwords, chunksize=chunksize))
+
+
+def verify_password(password, encoded):
+    """
+    Return whether ``password`` matches ``encoded`` and, when the stored
+    hash uses outdated parameters, the upgraded hash to save (else ``None``).
+    """
+    upgraded = []
+    is_correct = check_password(password, encoded, setter=lambda raw: upgraded.append(make_password(raw)))
+    return is_correct, upgraded[0] if upgraded else None
+
+
+class HashingPoolSaturated(Exception):
+    pass
+
+
+class HashingExecutor:
+    """
+    Bounded thread pool for running password hashers off the event loop.
+    Django's PBKDF2 hashing happens in ``hashlib``, which releases the GIL,
+    so threads hash in parallel. At most ``max_workers`` hashes run at once
+    and at most ``max_pending`` more wait for a thread; anything beyond that
+    is rejected right away with ``HashingPoolSaturated``.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hash_seconds = 0.0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.in_flight >= self.max_workers + self.max_pending:
+                self.rejected += 1
+                raise HashingPoolSaturated()
+            self.in_flight += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="membership-hashing")
+        try:
+            return await asyncio.wrap_future(self._executor.submit(self._timed, func, *args))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _timed(self, func, *args):
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                self.completed += 1
+                self.hash_seconds += elapsed
+
+    def stats(self):
+        return {
+            "queue_depth": max(0, self.in_flight - self.max_workers),
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "hash_seconds_total": self.hash_seconds,
+        }
+
+
+hashing_executor = HashingExecutor(
+    max_workers=getattr(settings, "MEMBERSHIP_PASSWORD_VERIFY_WORKERS", None) or os.cpu_count() or 1,
+    max_pending=getattr(settings, "MEMBERSHIP_PASSWORD_VERIFY_QUEUE", 64),
+)
@@ -0,0 +1,74 @@
+import json
+from jwt.algorithms import get_default_algorithms
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+ASYMMETRIC_ALGORITHMS = ("EdDSA", "RS256")
+
+
+class SigningKey:
+    __slots__ = ("kid", "algorithm", "private_key", "public_key")
+
+    def __init__(self, kid, algorithm, private_key=None, public_key=None):
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ImproperlyConfigured(f"Unsupported token signing algorithm: {algorithm}.")
+        try:
+            prepare_key = get_default_algorithms()[algorithm].prepare_key
+        except KeyError:
+            raise ImproperlyConfigured(
+                f"{algorithm} token signing requires the cryptography package, "
+                "install django-membership[crypto]."
+            )
+        self.kid = kid
+        self.algorithm = algorithm
+        self.private_key = prepare_key(private_key) if private_key else None
+        if public_key:
+            self.public_key = prepare_key(public_key)
+        elif self.private_key is not None:
+            self.public_key = self.private_key.public_key()
+        else:
+            raise ImproperlyConfigured(f"Token signing key {kid} needs a private or public key.")
+
+    def to_jwk(self):
+        jwk = json.loads(get_default_algorithms()[self.algorithm].to_jwk(self.public_key))
+        jwk.update(kid=self.kid, alg=self.algorithm, use="sig")
+        return jwk
+
+
+class KeySet:
+    """
+    Parsed ``MEMBERSHIP_TOKEN_SIGNING_KEYS``: a list of dicts with ``kid``,
+    ``algorithm`` and PEM encoded ``private_key`` and/or ``public_key``. The
+    first key with a private key signs new tokens, every key verifies, so
+    keys are rotated by adding the new key first and keeping the old one,
+    public key only, until the tokens it signed have expired.
+    """
+
+    def __init__(self, configs):
+        self.keys = {config["kid"]: SigningKey(**config) for config in configs}
+        self.signing_key = next(
+            (key for key in self.keys.values() if key.private_key is not None), None
+        )
+        if self.keys and self.signing_key is None:
+            raise ImproperlyConfigured("MEMBERSHIP_TOKEN_SIGNING_KEYS has no private key to sign with.")
+        self.jwks = {"keys": [key.to_jwk() for key in self.keys.values()]}
+
+    def __bool__(self):
+        return bool(self.keys)
+
+
+_key_set = None
+
+
+def get_key_set():
+    """Return the ``KeySet`` for the current settings, parsed once."""
+    global _key_set
+    if _key_set is None:
+        _key_set = KeySet(getattr(settings, "MEMBERSHIP_TOKEN_SIGNING_KEYS", []))
+    return _key_set
+
+
+def clear_key_set():
+    global _key_set
+    _key_set = None
@@ -0,0 +1,129 @@
+import json
+import platform
+import statistics
+from time import perf_counter
+from asgiref.sync import async_to_sync
+import django
+from django.core import mail
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from membership.auth import BearerAuthChannelsMiddleware, create_token
+from membership.models import User, EmailTemplate
+
+
+OPERATIONS = ("login", "account", "channels_connect", "set_username", "create_user", "send_to")
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the membership hot paths against a throwaway test database "
+        "and report ops/sec, p50/p99 latency and queries per operation."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--collisions", type=int, default=1000, help="Taken usernames for set_username.")
+        parser.add_argument("--operation", action="append", choices=OPERATIONS, help="Defaults to all of them.")
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+
+    def handle(self, iterations=200, warmup=10, collisions=1000, operation=None, output=None, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(MEMBERSHIP_EMAIL_OUTBOX=False):
+                self.setup(collisions)
+                results = {}
+                for name in operation or OPERATIONS:
+                    results[name] = self.measure(getattr(self, f"bench_{name}"), iterations, warmup)
+                    self.report(name, results[name])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        if output:
+            with open(output, "w") as file:
+                json.dump({
+                    "timestamp": timezone.now().isoformat(),
+                    "python": platform.python_version(),
+                    "django": django.get_version(),
+                    "database": connection.vendor,
+                    "iterations": iterations,
+                    "operations": results,
+                }, file, indent=2)
+
+    def setup(self, collisions):
+        self.user = User.objects.create_user(email="bench@bench.test", password="pass")
+        self.token = create_token(self.user)
+        self.client = Client()
+        User.objects.bulk_create(
+            User(username=f"taken{i}" if i > 1 else "taken", email=f"taken{i}@bench.test")
+            for i in range(1, collisions + 1)
+        )
+        self.template = EmailTemplate.objects.create(
+            name="bench", subject="Hello {user.username}", body="Your password is {password}."
+        )
+        self.middleware = BearerAuthChannelsMiddleware(self._channels_consumer)
+
+    @staticmethod
+    def measure(operation, iterations, warmup):
+        for i in range(warmup):
+            operation(-i - 1)
+        latencies, queries = [], 0
+        for i in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                start = perf_counter()
+                operation(i)
+                latencies.append(perf_counter() - start)
+            queries += len(captured)
+        percentiles = statistics.quantiles(latencies, n=100) if iterations > 1 else latencies * 99
+        return {
+            "ops_per_sec": round(iterations / sum(latencies), 1),
+            "p50_ms": round(percentiles[49] * 1000, 3),
+            "p99_ms": round(percentiles[98] * 1000, 3),
+            "queries_per_op": round(queries / iterations, 2),
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<18} {result['ops_per_sec']:>10} ops/s  p50 {result['p50_ms']:>9} ms  "
+            f"p99 {result['p99_ms']:>9} ms  {result['queries_per_op']:>6} queries/op"
+        )
+
+    @staticmethod
+    def expect(response, status):
+        # A failing request is usually much faster than a succeeding one, so
+        # don't let it pass for a result.
+        if response.status_code != status:
+            raise CommandError(f"{response.request['PATH_INFO']} returned {response.status_code}, expected {status}.")
+
+    def bench_login(self, i):
+        self.expect(self.client.post(
+            "/api/login", {"username": "bench", "password": "pass"}, content_type="application/json"
+        ), 200)
+
+    def bench_account(self, i):
+        self.expect(self.client.get("/api/account", headers={"authorization": f"Bearer {self.token}"}), 200)
+
+    @staticmethod
+    async def _channels_consumer(scope, receive, send):
+        await scope["user"].aget()
+
+    def bench_channels_connect(self, i):
+        async_to_sync(self.middleware)({
+            "type": "websocket", "user": AnonymousUser(),
+            "headers": [(b"authorization", f"Bearer {self.token}".encode())],
+        }, None, None)
+
+    def bench_set_username(self, i):
+        User(email="taken@bench.test").set_username("taken")
+
+    def bench_create_user(self, i):
+        User.objects.create_user(email=f"user{i}@bench.test", password="pass")
+
+    def bench_send_to(self, i):
+        self.template.send_to(self.user, password="pass")
+        mail.outbox.clear()
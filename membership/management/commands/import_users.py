@@ -0,0 +1,93 @@
+import csv
+import json
+import os
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.functions import Lower
+from membership.hashers import password_hashing_pool
+from membership.models import User
+
+
+FIELDS = ("email", "password", "first_name", "last_name")
+
+
+def read_csv(file):
+    for row in csv.DictReader(file):
+        yield row
+
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+class Command(BaseCommand):
+    help = (
+        "Create users from a CSV or JSON Lines file with email, password, "
+        "first_name and last_name fields. The file is streamed in batches and "
+        "progress is recorded in a checkpoint file, so an interrupted import "
+        "can be resumed by running the same command again. Users whose email "
+        "already exists are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=READERS, help="Defaults to the file extension.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, help="Password hashing processes, defaults to the CPU count.")
+        parser.add_argument("--checkpoint", help="Defaults to <path>.checkpoint.")
+
+    def handle(self, path, format=None, batch_size=1000, workers=None, checkpoint=None, **options):
+        format = format or os.path.splitext(path)[1].lstrip(".").lower()
+        if format not in READERS:
+            raise CommandError(f"Unknown format '{format}', use --format.")
+        checkpoint = checkpoint or f"{path}.checkpoint"
+        done = self.read_checkpoint(checkpoint)
+        if done:
+            self.stdout.write(f"Resuming after {done} records.")
+        with open(path, newline="") as file, password_hashing_pool(workers) as executor:
+            records = islice(READERS[format](file), done, None)
+            while batch := list(islice(records, batch_size)):
+                users = self.skip_existing([
+                    {k: v for k, v in record.items() if k in FIELDS and v} for record in batch
+                ])
+                User.objects.bulk_create_users(users, batch_size=batch_size, executor=executor)
+                if len(users) < len(batch):
+                    self.stdout.write(f"Skipped {len(batch) - len(users)} existing users.")
+                done += len(batch)
+                self.write_checkpoint(checkpoint, done)
+                self.stdout.write(f"Imported {done} records.")
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(f"Finished importing {done} records."))
+
+    @staticmethod
+    def skip_existing(users):
+        # A batch may have been committed just before the process died without
+        # its checkpoint being written, so resuming must tolerate seeing it again.
+        # Emails are compared lowered by the database, like the unique
+        # constraint on them.
+        emails = User.objects.lower([user["email"] for user in users])
+        existing = set(
+            User.objects.annotate(email_lower=Lower("email"))
+            .filter(email_lower__in=emails).values_list("email_lower", flat=True)
+        )
+        return [user for user, email in zip(users, emails) if email not in existing]
+
+    @staticmethod
+    def read_checkpoint(checkpoint):
+        try:
+            with open(checkpoint) as file:
+                return int(file.read())
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def write_checkpoint(checkpoint, done):
+        with open(f"{checkpoint}.tmp", "w") as file:
+            file.write(str(done))
+        os.replace(f"{checkpoint}.tmp", checkpoint)
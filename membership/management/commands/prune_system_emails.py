@@ -0,0 +1,28 @@
+from datetime import timedelta
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from membership.management.pruning import delete_in_chunks
+from membership.models import SystemEmail
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete sent and failed system emails older than --older-than days. "
+        "Rows are deleted in primary key ranges of --chunk-size, each in its "
+        "own transaction, sleeping --sleep seconds between chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, required=True, help="Age in days.")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--sleep", type=float, default=0.1)
+
+    def handle(self, older_than, chunk_size=1000, sleep=0.1, **options):
+        cutoff = timezone.now() - timedelta(days=older_than)
+        expired = (
+            Q(status=SystemEmail.SENT, sent_on__lt=cutoff) |
+            Q(status=SystemEmail.FAILED, created_on__lt=cutoff)
+        )
+        deleted = delete_in_chunks(SystemEmail.objects.filter(expired), chunk_size, sleep)
+        self.stdout.write(f"Deleted {deleted} system emails.")
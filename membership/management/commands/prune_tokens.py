@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from membership.management.pruning import delete_in_chunks
+from membership.models import RefreshToken, RevokedToken
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired refresh tokens and expired access token revocations. "
+        "Revoked refresh tokens are kept until they expire, since presenting "
+        "one revokes every token of its user. Rows are deleted in primary key "
+        "ranges of --chunk-size, each in its own transaction, sleeping --sleep "
+        "seconds between chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--sleep", type=float, default=0.1)
+
+    def handle(self, chunk_size=1000, sleep=0.1, **options):
+        now = timezone.now()
+        for model, label in ((RefreshToken, "refresh tokens"), (RevokedToken, "revoked tokens")):
+            deleted = delete_in_chunks(model.objects.filter(expires_on__lte=now), chunk_size, sleep)
+            self.stdout.write(f"Deleted {deleted} {label}.")
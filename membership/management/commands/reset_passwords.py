@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from membership.models import PasswordResetRequest
+
+
+class Command(BaseCommand):
+    help = (
+        "Reset the passwords of users queued by the admin reset password "
+        "action. Runs until interrupted unless --once is given, several "
+        "workers may run at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is drained.")
+
+    def handle(self, chunk_size=500, interval=5, once=False, **options):
+        while True:
+            processed = 0
+            while reset := PasswordResetRequest.objects.process_pending(chunk_size):
+                processed += reset
+            if processed:
+                self.stdout.write(f"Reset {processed} passwords.")
+            if once:
+                break
+            time.sleep(interval)
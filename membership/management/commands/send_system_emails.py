@@ -0,0 +1,40 @@
+import time
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from membership.models import SystemEmail
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver emails queued in the SystemEmail outbox. Runs until "
+        "interrupted unless --once is given, several workers may run at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to sleep when the outbox is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the outbox is drained.")
+
+    def handle(self, batch_size=100, interval=5, once=False, **options):
+        while True:
+            sent = self.drain(batch_size)
+            if sent:
+                self.stdout.write(f"Processed {sent} emails.")
+            if once:
+                break
+            time.sleep(interval)
+
+    @staticmethod
+    def drain(batch_size):
+        # One mail connection per drain, opened by deliver_pending() once
+        # there is something to send and closed again while the worker idles.
+        processed = 0
+        connection = get_connection()
+        try:
+            while claimed := SystemEmail.objects.deliver_pending(batch_size, connection):
+                processed += claimed
+                if claimed < batch_size:
+                    break
+        finally:
+            connection.close()
+        return processed
@@ -0,0 +1,20 @@
+import time
+from django.db.models import Max, Min
+
+
+def delete_in_chunks(queryset, chunk_size=1000, sleep=0.1):
+    """
+    Delete the rows of ``queryset`` in primary key ranges of ``chunk_size``,
+    each in its own transaction, sleeping ``sleep`` seconds after each chunk
+    that deleted something. Returns the number of rows deleted.
+    """
+    bounds = queryset.model._default_manager.using(queryset.db).aggregate(first=Min("pk"), last=Max("pk"))
+    if bounds["first"] is None:
+        return 0
+    deleted = 0
+    for start in range(bounds["first"], bounds["last"] + 1, chunk_size):
+        count, _ = queryset.filter(pk__gte=start, pk__lt=start + chunk_size).delete()
+        deleted += count
+        if sleep and count:
+            time.sleep(sleep)
+    return deleted
@@ -0,0 +1,283 @@
+import os
+import json
+import atexit
+import asyncio
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter, sleep, time_ns
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# [queries] of the innermost instrumented call in progress, if any
+_queries = ContextVar("membership_metrics_queries", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _watch_connection(connection):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class Registry:
+    """
+    Process-local call counters, latency histograms and query counts per
+    instrumented operation. When ``MEMBERSHIP_METRICS_DIR`` is set, the
+    process periodically writes its samples to a file of its own in that
+    directory, and ``render()`` sums the files of every worker. Files of
+    exited workers keep contributing their counters but not their gauges.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.flush_interval = 5
+        self._operations = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._file = None
+
+    def configure(self):
+        self.enabled = getattr(settings, "MEMBERSHIP_METRICS", False)
+        self.directory = getattr(settings, "MEMBERSHIP_METRICS_DIR", None)
+        self.flush_interval = getattr(settings, "MEMBERSHIP_METRICS_FLUSH_INTERVAL", 5)
+        if self.enabled:
+            for connection in connections.all(initialized_only=True):
+                _watch_connection(connection)
+            if self.directory and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+                self._flusher.start()
+                atexit.register(self.flush)
+
+    def observe(self, operation, duration, queries, failed):
+        with self._lock:
+            samples = self._operations.get(operation)
+            if samples is None:
+                samples = self._operations[operation] = {
+                    "calls": 0, "errors": 0, "queries": 0, "duration_sum": 0.0,
+                    "buckets": [0] * (len(DURATION_BUCKETS) + 1),
+                }
+            samples["calls"] += 1
+            samples["errors"] += failed
+            samples["queries"] += queries
+            samples["duration_sum"] += duration
+            samples["buckets"][bisect_left(DURATION_BUCKETS, duration)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: dict(samples, buckets=list(samples["buckets"]))
+                for operation, samples in self._operations.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._operations.clear()
+
+    def _path(self):
+        # Named after the pid and the time this process first wrote one, so a
+        # new worker reusing the pid of an exited one doesn't overwrite (and
+        # rewind) the counters the exited one left behind.
+        pid = os.getpid()
+        if self._file is None or self._file[0] != pid:
+            self._file = (pid, f"membership-{pid}-{time_ns()}.json")
+        return os.path.join(self.directory, self._file[1])
+
+    def flush(self):
+        if not self.directory:
+            return
+        path = self._path()
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({"operations": self.snapshot(), "stats": collect_stats()}, file)
+        os.replace(f"{path}.tmp", path)
+
+    def _flush_forever(self):
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        """
+        Return operation samples and component stats summed over every
+        worker that wrote to ``MEMBERSHIP_METRICS_DIR``, with the current
+        process contributing its live values.
+        """
+        reports = [{"operations": self.snapshot(), "stats": collect_stats()}]
+        if self.directory and os.path.isdir(self.directory):
+            own = os.path.basename(self._path())
+            latest = {}
+            files = []
+            for name in os.listdir(self.directory):
+                if not (name.startswith("membership-") and name.endswith(".json")) or name == own:
+                    continue
+                try:
+                    pid, started = map(int, name[len("membership-"):-len(".json")].split("-"))
+                except ValueError:
+                    continue
+                files.append((name, pid, started))
+                latest[pid] = max(latest.get(pid, started), started)
+            for name, pid, started in files:
+                try:
+                    with open(os.path.join(self.directory, name)) as file:
+                        report = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                if started != latest[pid] or not _alive(pid):
+                    report["stats"] = {
+                        component: {key: value for key, value in values.items() if key.endswith("_total")}
+                        for component, values in report["stats"].items()
+                    }
+                reports.append(report)
+        operations, stats = {}, {}
+        for report in reports:
+            for operation, samples in report["operations"].items():
+                total = operations.setdefault(operation, {
+                    "calls": 0, "errors": 0, "queries": 0, "duration_sum": 0.0,
+                    "buckets": [0] * (len(DURATION_BUCKETS) + 1),
+                })
+                for field in ("calls", "errors", "queries", "duration_sum"):
+                    total[field] += samples[field]
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], samples["buckets"])]
+            for component, values in report["stats"].items():
+                total = stats.setdefault(component, {})
+                for key, value in values.items():
+                    total[key] = total.get(key, 0) + value
+        return operations, stats
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        operations, stats = self.collect()
+        lines = [
+            "# HELP membership_calls_total Calls of an instrumented operation.",
+            "# TYPE membership_calls_total counter",
+        ]
+        lines += [f'membership_calls_total{{operation="{op}"}} {s["calls"]}' for op, s in operations.items()]
+        lines += [
+            "# HELP membership_errors_total Calls of an instrumented operation that raised.",
+            "# TYPE membership_errors_total counter",
+        ]
+        lines += [f'membership_errors_total{{operation="{op}"}} {s["errors"]}' for op, s in operations.items()]
+        lines += [
+            "# HELP membership_queries_total Database queries run by an instrumented operation.",
+            "# TYPE membership_queries_total counter",
+        ]
+        lines += [f'membership_queries_total{{operation="{op}"}} {s["queries"]}' for op, s in operations.items()]
+        lines += [
+            "# HELP membership_duration_seconds Latency of an instrumented operation.",
+            "# TYPE membership_duration_seconds histogram",
+        ]
+        for op, samples in operations.items():
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + ("+Inf",), samples["buckets"]):
+                cumulative += count
+                lines.append(f'membership_duration_seconds_bucket{{operation="{op}",le="{bound}"}} {cumulative}')
+            lines.append(f'membership_duration_seconds_sum{{operation="{op}"}} {samples["duration_sum"]}')
+            lines.append(f'membership_duration_seconds_count{{operation="{op}"}} {samples["calls"]}')
+        for component, values in stats.items():
+            for key, value in values.items():
+                name = f"membership_{component}_{key}"
+                lines += [f"# TYPE {name} {'counter' if key.endswith('total') else 'gauge'}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_stats():
+    from .auth import user_cache, token_cache
+    from .hashers import hashing_executor
+    stats = {"hashing": hashing_executor.stats()}
+    for name, lru in (("user_cache", user_cache), ("token_cache", token_cache)):
+        values = lru.stats()
+        stats[name] = {
+            "hits_total": values["hits"], "misses_total": values["misses"], "size": values["size"],
+        }
+    stats["hashing"]["completed_total"] = stats["hashing"].pop("completed")
+    stats["hashing"]["rejected_total"] = stats["hashing"].pop("rejected")
+    return stats
+
+
+registry = Registry()
+
+
+def instrument(operation):
+    """
+    Record calls, errors, latency and database queries of the decorated
+    function or coroutine function under ``operation``. While metrics are
+    disabled, the wrapper only checks a flag before calling through.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not registry.enabled:
+                    return await func(*args, **kwargs)
+                counter, token = _start()
+                failed = True
+                start = perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    _finish(operation, start, counter, token, failed)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not registry.enabled:
+                    return func(*args, **kwargs)
+                counter, token = _start()
+                failed = True
+                start = perf_counter()
+                try:
+                    result = func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    _finish(operation, start, counter, token, failed)
+        return wrapper
+    return decorator
+
+
+def _start():
+    counter = [0]
+    return counter, _queries.set(counter)
+
+
+def _finish(operation, start, counter, token, failed):
+    duration = perf_counter() - start
+    _queries.reset(token)
+    parent = _queries.get()
+    if parent is not None:
+        parent[0] += counter[0]
+    registry.observe(operation, duration, counter[0], failed)
+
+
+def watch_new_connection(sender, connection, **kwargs):
+    # Always installed: outside an instrumented call it costs one lookup.
+    _watch_connection(connection)
+
+
+connection_created.connect(watch_new_connection)
+registry.configure()
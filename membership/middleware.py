@@ -0,0 +1,140 @@
+import jwt
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import AnonymousUser
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.functional import SimpleLazyObject
+from .auth import aget_user, create_token, get_user, read_claims, revoke_token
+
+
+def _cookie_name():
+    return getattr(settings, "MEMBERSHIP_TOKEN_COOKIE_NAME", "membership_token")
+
+
+def _cookie_lifetime():
+    return getattr(
+        settings, "MEMBERSHIP_TOKEN_COOKIE_LIFETIME", timedelta(seconds=settings.SESSION_COOKIE_AGE)
+    )
+
+
+def session_hash(user):
+    """
+    Digest of ``user.get_session_auth_hash()`` embedded in cookie tokens, so
+    that changing the password logs out every other device like it does
+    with sessions, without putting the session hash itself in the token.
+    """
+    return salted_hmac("membership.middleware.session_hash", user.get_session_auth_hash()).hexdigest()
+
+
+def _verified(claims, user):
+    if user is None or not constant_time_compare(claims.get("sah", ""), session_hash(user)):
+        return AnonymousUser()
+    return user
+
+
+class TokenSession(dict):
+    """
+    Stand-in for ``request.session`` under ``TokenCookieMiddleware``, just
+    enough for ``login()``, ``logout()`` and ``update_session_auth_hash()``.
+    It holds the id of the user the token cookie was issued to and records
+    whether the view logged someone in or out, or cycled the key after a
+    password change, so the middleware can reissue or delete the cookie.
+    Anything else stored in it lasts for the current request only.
+    """
+
+    def __init__(self, claims=None):
+        super().__init__()
+        if claims is not None:
+            super().__setitem__(SESSION_KEY, str(claims["id"]))
+        self.modified = False
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key == SESSION_KEY:
+            self.modified = True
+
+    def cycle_key(self):
+        self.modified = True
+
+    def flush(self):
+        self.clear()
+        self.modified = True
+
+    async def acycle_key(self):
+        self.cycle_key()
+
+    async def aflush(self):
+        self.flush()
+
+
+class TokenCookieMiddleware:
+    """
+    Replaces ``SessionMiddleware`` and ``AuthenticationMiddleware`` with a
+    token from ``create_token()`` kept in an HttpOnly cookie, so identifying
+    the user is a signature check plus a ``user_cache`` lookup instead of a
+    session row read and a user query. Existing views keep working through
+    ``TokenSession``: logging in issues a new cookie, logging out or
+    changing the password revokes the old token, and tokens carry a digest
+    of the session auth hash so a password change also logs out every
+    other device. CSRF protection needs
+    ``CSRF_USE_SESSIONS`` left off, its default.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.COOKIES.get(_cookie_name())
+        claims = None
+        if token:
+            try:
+                claims = read_claims(token)
+            except jwt.InvalidTokenError:
+                token = None
+        request.session = TokenSession(claims)
+        request.user = SimpleLazyObject(lambda: self.get_user(claims))
+        request.auser = lambda: self.aget_user(claims)
+        response = self.get_response(request)
+        return self.process_response(request, token, response)
+
+    @staticmethod
+    def get_user(claims):
+        if not claims:
+            return AnonymousUser()
+        return _verified(claims, get_user(claims["id"]))
+
+    @staticmethod
+    async def aget_user(claims):
+        if not claims:
+            return AnonymousUser()
+        return _verified(claims, await aget_user(claims["id"]))
+
+    def process_response(self, request, token, response):
+        session = request.session
+        if not session.modified:
+            return response
+        if token:
+            revoke_token(token)
+        if SESSION_KEY in session and request.user.is_authenticated:
+            lifetime = _cookie_lifetime()
+            response.set_cookie(
+                _cookie_name(),
+                create_token(
+                    request.user, lifetime=lifetime, extra_claims={"sah": session_hash(request.user)}
+                ),
+                max_age=int(lifetime.total_seconds()),
+                path=settings.SESSION_COOKIE_PATH,
+                domain=settings.SESSION_COOKIE_DOMAIN,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        elif token:
+            response.delete_cookie(
+                _cookie_name(),
+                path=settings.SESSION_COOKIE_PATH,
+                domain=settings.SESSION_COOKIE_DOMAIN,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        return response
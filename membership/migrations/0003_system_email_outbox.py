@@ -0,0 +1,64 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def copy_sent_on(apps, schema_editor):
+    SystemEmail = apps.get_model("membership", "SystemEmail")
+    SystemEmail.objects.update(created_on=models.F("sent_on"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0002_user_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systememail',
+            name='subject',
+            field=models.CharField(blank=True, max_length=256),
+        ),
+        # Emails recorded before the outbox existed have already been sent.
+        migrations.AddField(
+            model_name='systememail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='sent', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='systememail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='systememail',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='systememail',
+            name='next_attempt_on',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='systememail',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='systememail',
+            name='created_on',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='systememail',
+            name='sent_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_sent_on, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='systememail',
+            index=models.Index(fields=['status', 'next_attempt_on'], name='membership_outbox_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:35
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0003_system_email_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='systememail',
+            index=models.Index(fields=['recipient', 'sent_on'], name='membership_email_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='systememail',
+            index=models.Index(fields=['name', 'sent_on'], name='membership_email_name_idx'),
+        ),
+        migrations.AlterField(
+            model_name='systememail',
+            name='recipient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='emails', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0005_refresh_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(max_length=64, unique=True)),
+                ('expires_on', models.DateTimeField()),
+                ('revoked_on', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
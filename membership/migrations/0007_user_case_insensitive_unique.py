@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:48
+
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def report_duplicates(apps, schema_editor):
+    User = apps.get_model("membership", "User")
+    duplicates = []
+    for field in ("email", "username"):
+        clashes = (
+            User.objects.using(schema_editor.connection.alias)
+            .values(lowered=Lower(field)).annotate(count=Count("id")).filter(count__gt=1)
+        )
+        for clash in clashes:
+            values = User.objects.using(schema_editor.connection.alias).alias(
+                lowered=Lower(field)
+            ).filter(lowered=clash["lowered"]).values_list("id", field)
+            duplicates.append(f"{field} {clash['lowered']!r}: " + ", ".join(
+                f"{value!r} (id {pk})" for pk, value in values
+            ))
+    if duplicates:
+        raise RuntimeError(
+            "Users differing only in letter case must be merged or renamed before "
+            "case-insensitive uniqueness can be enforced:\n" + "\n".join(duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0006_revoked_token'),
+    ]
+
+    # The unique indexes are built without CONCURRENTLY, which blocks writes
+    # to the user table while they build. On a large PostgreSQL table, create
+    # them beforehand with CREATE UNIQUE INDEX CONCURRENTLY under the same
+    # names and fake this migration.
+    operations = [
+        migrations.RunPython(report_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='membership_user_email_ci_unique', violation_error_message='A user with that email address already exists.'),
+        ),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('username'), name='membership_user_username_ci_unique', violation_error_message='A user with that username already exists.'),
+        ),
+    ]
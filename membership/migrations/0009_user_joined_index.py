@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:54
+
+import django.db.models.functions.text
+import membership.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('membership', '0008_user_last_seen'),
+    ]
+
+    # Like in 0007, the indexes are built without CONCURRENTLY; on a large
+    # PostgreSQL table create them beforehand and fake this migration.
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['date_joined', 'id'], name='membership_user_joined_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(membership.models.CodePointOrder(django.db.models.functions.text.Lower('username')), name='membership_username_cp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(membership.models.CodePointOrder(django.db.models.functions.text.Lower('email')), name='membership_email_cp_idx'),
+        ),
+    ]
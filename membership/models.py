@@ -1,37 +1,214 @@
-from django.db import models
+import re
+import time
+from string import Formatter
+from contextlib import nullcontext
+from datetime import timedelta
+from itertools import islice
+from django.db import connections, models, transaction, IntegrityError
+from django.db.models import Func, Q, Value
+from django.db.models.functions import Collate, Lower
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from .cache import bump_versions, version_timeout
+from .hashers import password_hashing_pool, password_hashing_threads, hash_passwords
+from .metrics import instrument
 
 
 DEFAULT_RANDOM_PASSWORD_CHARS = "abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+USERNAME_ALLOCATION_ATTEMPTS = 5
+USERNAME_PREFIXES_PER_QUERY = 100
+
+
+class CodePointOrder(Func):
+    """
+    Compare ``expression`` by code point, so that a range of strings is a
+    prefix: ``COLLATE "C"`` on PostgreSQL, where text otherwise follows the
+    database collation. SQLite already compares text by code point.
+    """
+    arity = 1
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return compiler.compile(self.source_expressions[0])
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return Collate(self.source_expressions[0], "C").as_sql(compiler, connection)
+
+
+def prefix_range(field, prefix):
+    """
+    Match values of ``field``, a ``CodePointOrder`` expression, starting with
+    non-empty ``prefix``. The match is a range the field's index can seek,
+    unlike the LIKE that startswith compiles to under non-C collations.
+    """
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f"{field}__gte": prefix, f"{field}__lt": end})
 
 
 class UserManager(BaseUserManager):
 
-    def get_by_natural_key(self, username):
+    def _natural_key_lookup(self, username):
+        # Compare lowered values so the lookup is a probe of the unique
+        # Lower() index instead of a scan like __iexact would be. Both sides
+        # are lowered by the database, whose LOWER() can disagree with
+        # str.lower() outside ASCII (SQLite only folds ASCII).
         if '@' in username:
-            return self.get(email=username)
-        else:
-            return self.get(username=username)
+            return self.alias(email_lower=Lower("email")), {"email_lower": Lower(Value(username))}
+        return self.alias(username_lower=Lower("username")), {"username_lower": Lower(Value(username))}
+
+    def lower(self, values):
+        """
+        Return ``values`` lowered by the database's LOWER(), which the case
+        insensitive unique constraints are defined with. ``str.lower()``
+        agrees with it on ASCII, so only the other values cost a query.
+        """
+        others = list(dict.fromkeys(value for value in values if not value.isascii()))
+        lowered = {}
+        if others:
+            with connections[self.db].cursor() as cursor:
+                cursor.execute("SELECT " + ", ".join(["LOWER(%s)"] * len(others)), others)
+                lowered = dict(zip(others, cursor.fetchone()))
+        return [lowered[value] if value in lowered else value.lower() for value in values]
+
+    def get_by_natural_key(self, username):
+        queryset, lookup = self._natural_key_lookup(username)
+        return queryset.get(**lookup)
+
+    async def aget_by_natural_key(self, username):
+        queryset, lookup = self._natural_key_lookup(username)
+        return await queryset.aget(**lookup)
+
+    def search(self, prefix):
+        """
+        Return users whose username or email starts with ``prefix``, ignoring
+        case. The prefix is matched as a range on the lowered columns in code
+        point order, which their prefix indexes serve, unlike __istartswith.
+        """
+        if not prefix:
+            return self.all()
+        prefix, = self.lower([prefix])
+        return self.alias(
+            username_key=CodePointOrder(Lower("username")), email_key=CodePointOrder(Lower("email"))
+        ).filter(prefix_range("username_key", prefix) | prefix_range("email_key", prefix))
+
+    def filter_usernames(self, usernames):
+        """Return users whose username matches any of ``usernames``, ignoring case."""
+        return self.alias(username_lower=Lower("username")).filter(
+            username_lower__in=[Lower(Value(username)) for username in usernames]
+        )
 
     def _create_user(self, email, password, **extra_fields):
         assert '@' in email
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
-        user.set_username(email[:email.index('@')])
         user.set_password(password)
-        user.save(using=self._db)
-        return user
+        for attempt in range(USERNAME_ALLOCATION_ATTEMPTS):
+            user.set_username(email[:email.index('@')])
+            try:
+                with transaction.atomic(using=self._db):
+                    user.save(using=self._db)
+                return user
+            except IntegrityError:
+                # A concurrent signup may have claimed the same username
+                # between allocating and inserting it, pick another one.
+                if not self.filter_usernames([user.username]).exists():
+                    raise
+        raise ValueError(f"Unable to allocate a unique username for {email}.")
 
     def create_user(self, email, password=None, **extra_fields):
         extra_fields.setdefault("is_staff", False)
         extra_fields.setdefault("is_superuser", False)
         return self._create_user(email, password, **extra_fields)
 
+    def bulk_create_users(self, users, batch_size=1000, workers=None, executor=None):
+        """
+        Create users from an iterable of ``create_user()`` keyword argument
+        dicts, ``batch_size`` at a time. Each batch gets its usernames
+        allocated together, its passwords hashed on a pool of ``workers``
+        processes (or on ``executor``) and is inserted with ``bulk_create()``.
+        Returns the number of users created.
+        """
+        if executor is None:
+            with password_hashing_pool(workers) as pool:
+                return self._bulk_create_users(users, batch_size, pool)
+        return self._bulk_create_users(users, batch_size, executor)
+
+    def _bulk_create_users(self, users, batch_size, executor):
+        users = iter(users)
+        created = 0
+        while batch := list(islice(users, batch_size)):
+            created += len(self._bulk_create_batch(batch, executor))
+        return created
+
+    def _bulk_create_batch(self, batch, executor):
+        instances = []
+        for fields in batch:
+            fields = dict(fields)
+            fields.setdefault("is_staff", False)
+            fields.setdefault("is_superuser", False)
+            email = self.normalize_email(fields.pop("email"))
+            assert '@' in email
+            password = fields.pop("password", None)
+            instances.append((self.model(email=email, **fields), password))
+        passwords = hash_passwords([password for _, password in instances], executor)
+        users = [user for user, _ in instances]
+        for user, password in zip(users, passwords):
+            user.password = password
+        for attempt in range(USERNAME_ALLOCATION_ATTEMPTS):
+            usernames = self.allocate_usernames([
+                user.email[:user.email.index('@')] for user in users
+            ])
+            for user, username in zip(users, usernames):
+                user.username = username
+            try:
+                with transaction.atomic(using=self._db):
+                    return self.bulk_create(users)
+            except IntegrityError:
+                if not self.filter_usernames(usernames).exists():
+                    raise
+        raise ValueError("Unable to allocate unique usernames for the batch.")
+
+    def allocate_usernames(self, bases):
+        """
+        Return a unique username for each of ``bases``, picking suffixes like
+        ``User.set_username()`` does and never handing out the same name
+        twice. Usernames are unique ignoring case, so ``Lex`` is taken when
+        ``lex`` exists. Taken names, the bases and the bases followed by
+        digits, are fetched with one index-backed prefix query per
+        ``USERNAME_PREFIXES_PER_QUERY`` distinct bases. Names are compared
+        as lowered by the database, see ``lower()``.
+        """
+        keys = self.lower(bases)
+        prefixes = list(dict.fromkeys(keys))
+        taken = set()
+        queryset = self.annotate(username_key=CodePointOrder(Lower("username")))
+        for i in range(0, len(prefixes), USERNAME_PREFIXES_PER_QUERY):
+            query = Q()
+            for prefix in prefixes[i:i + USERNAME_PREFIXES_PER_QUERY]:
+                # Only the base itself or the base followed by a suffix can
+                # collide, don't load every name that merely shares the prefix.
+                query |= prefix_range("username_key", prefix) & Q(
+                    username_key__regex=rf"^{re.escape(prefix)}[0-9]*$"
+                )
+            taken.update(queryset.filter(query).values_list("username_key", flat=True))
+        next_suffix = {}
+        usernames = []
+        # Suffixes are digits, which lowering leaves alone, so a candidate's
+        # lowered form is its base's lowered form followed by the suffix.
+        for base, key in zip(bases, keys):
+            candidate, suffix, i = base, "", next_suffix.get(key, 2)
+            while key + suffix in taken:
+                suffix, i = str(i), i + 1
+                candidate = f"{base}{suffix}"
+            next_suffix[key] = i
+            taken.add(key + suffix)
+            usernames.append(candidate)
+        return usernames
+
     def create_superuser(self, email, password=None, **extra_fields):
         extra_fields.setdefault("is_staff", True)
         extra_fields.setdefault("is_superuser", True)
@@ -41,6 +218,30 @@ class UserManager(BaseUserManager):
             raise ValueError("Superuser must have is_superuser=True.")
         return self._create_user(email, password, **extra_fields)
 
+    def reset_passwords(self, users, chunk_size=500, workers=None):
+        """
+        Give each of ``users`` a new random password and email it to them
+        with the welcome email. Passwords are hashed on a pool of ``workers``
+        threads and saved with one ``bulk_update()`` per ``chunk_size`` users,
+        so this is safe to call from a web request. Emails are
+        queued in the outbox with the passwords or, with the outbox disabled,
+        all go out over a single mail connection.
+        """
+        template = EmailTemplate.objects.get_welcome_email()
+        users = iter(users)
+        connection = nullcontext() if outbox_enabled() else get_connection()
+        with password_hashing_threads(workers) as executor, connection:
+            while chunk := list(islice(users, chunk_size)):
+                passwords = [self.generate_password() for _ in chunk]
+                for user, encoded in zip(chunk, hash_passwords(passwords, executor)):
+                    user.password = encoded
+                with transaction.atomic(using=self.db):
+                    self.bulk_update(chunk, ["password"])
+                    SystemEmail.objects.send(template.name, [
+                        (user, template.build_message(user, password=password))
+                        for user, password in zip(chunk, passwords)
+                    ], connection=connection)
+
     @staticmethod
     def generate_password(length=8, allowed_chars=DEFAULT_RANDOM_PASSWORD_CHARS):
         return get_random_string(length, allowed_chars)
@@ -79,16 +280,66 @@ class User(AbstractBaseUser, PermissionsMixin):
         ),
     )
     date_joined = models.DateTimeField("date joined", default=timezone.now)
+    last_seen = models.DateTimeField("last seen", blank=True, null=True)
+    token_version = models.PositiveIntegerField(
+        "token version",
+        default=0,
+        editable=False,
+        help_text="Incremented whenever a field embedded in token claims changes.",
+    )
 
     objects = UserManager()
 
     EMAIL_FIELD = "email"
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
+    TOKEN_CLAIM_FIELDS = ("username", "is_active", "is_staff")
 
     class Meta:
         verbose_name = "user"
         verbose_name_plural = "users"
+        indexes = [
+            models.Index(fields=["date_joined", "id"], name="membership_user_joined_idx"),
+            # Serve the prefix ranges of search() and allocate_usernames().
+            models.Index(CodePointOrder(Lower("username")), name="membership_username_cp_idx"),
+            models.Index(CodePointOrder(Lower("email")), name="membership_email_cp_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                Lower("email"), name="membership_user_email_ci_unique",
+                violation_error_message="A user with that email address already exists.",
+            ),
+            models.UniqueConstraint(
+                Lower("username"), name="membership_user_username_ci_unique",
+                violation_error_message="A user with that username already exists.",
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_token_claims = {
+            field: getattr(user, field)
+            for field in cls.TOKEN_CLAIM_FIELDS if field in field_names
+        }
+        return user
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, "_loaded_token_claims", None)
+        if loaded and any(value != getattr(self, field) for field, value in loaded.items()):
+            self.token_version += 1
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "token_version"}
+        super().save(*args, **kwargs)
+        self._loaded_token_claims = {
+            field: getattr(self, field) for field in self.TOKEN_CLAIM_FIELDS
+        }
+
+    def get_token_claims(self):
+        """Return the user fields embedded in tokens when claims mode is enabled."""
+        claims = {field: getattr(self, field) for field in self.TOKEN_CLAIM_FIELDS}
+        claims["ver"] = self.token_version
+        return claims
 
     def clean(self):
         super().clean()
@@ -105,14 +356,15 @@ class User(AbstractBaseUser, PermissionsMixin):
         """Return the short name for the user."""
         return self.first_name
 
+    @instrument("set_username")
     def set_username(self, username):
-        _username = username
-        for i in range(2, 1000):
-            if not User.objects.filter(username=username).exists():
-                self.username = username
-                return username
-            username = f"{_username}{i}"
-        raise ValueError(f"Exhausted attempts to create a unique username from {_username}.")
+        """
+        Set the username to ``username`` or, if it's taken, to ``username``
+        followed by the lowest free numeric suffix starting at 2. All taken
+        candidates are fetched with a single prefix query.
+        """
+        self.username = User.objects.allocate_usernames([username])[0]
+        return self.username
 
     def send_welcome_email(self, password):
         EmailTemplate.objects.get_welcome_email().send_to(
@@ -120,18 +372,166 @@ class User(AbstractBaseUser, PermissionsMixin):
         )
 
 
+def outbox_enabled():
+    return getattr(settings, "MEMBERSHIP_EMAIL_OUTBOX", True)
+
+
+class SystemEmailManager(models.Manager):
+
+    def send(self, name, messages, connection=None):
+        """
+        Send ``messages``, a list of ``(recipient, EmailMessage)`` pairs. With
+        the outbox enabled (``MEMBERSHIP_EMAIL_OUTBOX``, the default) they are
+        queued for the ``send_system_emails`` worker instead. The rows are
+        written in the current transaction, so they are committed together
+        with the recipients they are about.
+        """
+        if not outbox_enabled():
+            connection = connection or get_connection()
+            return connection.send_messages([message for _, message in messages])
+        emails = [
+            SystemEmail(name=name, subject=message.subject, text=message.body, recipient=recipient)
+            for recipient, message in messages
+        ]
+        self.bulk_create(emails)
+
+    def deliver_pending(self, batch_size=100, connection=None):
+        """
+        Claim up to ``batch_size`` due emails and try to deliver them over
+        ``connection``. Rows are claimed with ``SELECT ... FOR UPDATE SKIP
+        LOCKED`` where supported so that several workers can drain the outbox
+        at once. The connection is only opened once there is something to
+        send. Failed sends, including failing to connect, are retried with
+        exponential backoff until ``MEMBERSHIP_EMAIL_MAX_ATTEMPTS`` is
+        reached. Sent and failed emails have their text blanked, since it may
+        contain a password. Returns the number of emails claimed.
+        """
+        max_attempts = getattr(settings, "MEMBERSHIP_EMAIL_MAX_ATTEMPTS", 5)
+        backoff = getattr(settings, "MEMBERSHIP_EMAIL_RETRY_BACKOFF", 60)
+        connection = connection or get_connection()
+        with transaction.atomic(using=self.db):
+            pending = (
+                self.filter(status=SystemEmail.PENDING, next_attempt_on__lte=timezone.now())
+                .select_related("recipient").order_by("next_attempt_on")
+            )
+            if transaction.get_connection(self.db).features.has_select_for_update_skip_locked:
+                pending = pending.select_for_update(skip_locked=True, of=("self",))
+            emails = list(pending[:batch_size])
+            for email in emails:
+                email.attempts += 1
+                try:
+                    if email is emails[0]:
+                        connection.open()
+                    connection.send_messages([EmailMessage(
+                        email.subject, email.text, settings.DEFAULT_FROM_EMAIL, [email.recipient.email]
+                    )])
+                except Exception as error:
+                    email.last_error = repr(error)
+                    if email.attempts >= max_attempts:
+                        email.status = SystemEmail.FAILED
+                        email.text = ""
+                    else:
+                        email.next_attempt_on = timezone.now() + timedelta(
+                            seconds=backoff * 2 ** (email.attempts - 1)
+                        )
+                else:
+                    email.status = SystemEmail.SENT
+                    email.sent_on = timezone.now()
+                    email.text = ""
+            self.bulk_update(emails, ["status", "attempts", "next_attempt_on", "last_error", "sent_on", "text"])
+        return len(emails)
+
+
 class SystemEmail(models.Model):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = ((PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed"))
+
     name = models.CharField(max_length=256)
+    subject = models.CharField(max_length=256, blank=True)
     text = models.TextField()
-    recipient = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="emails")
-    sent_on = models.DateTimeField(auto_now_add=True)
+    # Indexed by the (recipient, sent_on) index below.
+    recipient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="emails", db_index=False
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_on = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    sent_on = models.DateTimeField(null=True, blank=True)
+
+    objects = SystemEmailManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_on"], name="membership_outbox_idx"),
+            models.Index(fields=["recipient", "sent_on"], name="membership_email_recipient_idx"),
+            models.Index(fields=["name", "sent_on"], name="membership_email_name_idx"),
+        ]
+
+
+class CompiledEmailTemplate:
+    """
+    Immutable snapshot of an ``EmailTemplate`` whose subject and body were
+    parsed and validated once, for rendering to many recipients.
+    """
+    __slots__ = ("name", "subject", "body")
+
+    def __init__(self, name, subject, body):
+        for template in (subject, body):
+            for _, field, _, _ in Formatter().parse(template):
+                if field is not None and not field.partition(".")[0].partition("[")[0].isidentifier():
+                    raise ValueError(f"Email template {name} uses a positional field: {{{field}}}")
+        self.name = name
+        self.subject = subject
+        self.body = body
+
+    def render(self, user, **kwargs):
+        kwargs["user"] = user
+        return self.subject.format_map(kwargs), self.body.format_map(kwargs)
+
+    def render_many(self, users, **kwargs):
+        """Return a ``(subject, body)`` pair for each of ``users``."""
+        return [self.render(user, **kwargs) for user in users]
+
+    def build_message(self, user, **kwargs):
+        subject, body = self.render(user, **kwargs)
+        return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email])
+
+    @instrument("send_to")
+    def send_to(self, user, **kwargs):
+        SystemEmail.objects.send(self.name, [(user, self.build_message(user, **kwargs))])
 
 
 class EmailTemplateManager(models.Manager):
     WELCOME_EMAIL_NAME = "welcome-email"
+    VERSION_KEY = "membership:email-template-version"
+
+    # name -> (version, CompiledEmailTemplate), shared by the whole process
+    _compiled = {}
+
+    def get_compiled(self, name):
+        """
+        Return the ``CompiledEmailTemplate`` for ``name`` from the process
+        cache. Entries are reloaded when the version kept in the Django cache
+        changes, which happens whenever any template is saved or deleted,
+        and at the latest every ``version_timeout()`` seconds.
+        """
+        version = cache.get_or_set(self.VERSION_KEY, time.time_ns, version_timeout())
+        entry = self._compiled.get(name)
+        if entry is None or entry[0] != version:
+            entry = (version, self.get(name=name).compile())
+            self._compiled[name] = entry
+        return entry[1]
+
+    def invalidate_compiled(self):
+        bump_versions([self.VERSION_KEY])
+        self._compiled.clear()
 
     def get_welcome_email(self):
-        return self.get(name=self.WELCOME_EMAIL_NAME)
+        return self.get_compiled(self.WELCOME_EMAIL_NAME)
 
 
 class EmailTemplate(models.Model):
@@ -141,10 +541,68 @@ class EmailTemplate(models.Model):
 
     objects = EmailTemplateManager()
 
+    def compile(self):
+        return CompiledEmailTemplate(self.name, self.subject, self.body)
+
+    def build_message(self, user, **kwargs):
+        return self.compile().build_message(user, **kwargs)
+
     def send_to(self, user, **kwargs):
-        send_mail(
-            self.subject.format(user=user, **kwargs),
-            self.body.format(user=user, **kwargs),
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-        )
+        self.compile().send_to(user, **kwargs)
+
+
+class PasswordResetRequestManager(models.Manager):
+
+    def process_pending(self, chunk_size=500):
+        """
+        Reset the passwords of up to ``chunk_size`` queued users and remove
+        their requests, in one transaction so that a crash leaves them
+        queued. Requests are claimed with ``SKIP LOCKED`` where supported,
+        so several workers can share the queue. Returns the number processed.
+        """
+        with transaction.atomic(using=self.db):
+            pending = self.order_by("id")
+            if transaction.get_connection(self.db).features.has_select_for_update_skip_locked:
+                pending = pending.select_for_update(skip_locked=True)
+            ids = list(pending.values_list("id", "user_id")[:chunk_size])
+            if ids:
+                User.objects.reset_passwords(
+                    User.objects.filter(pk__in=[user_id for _, user_id in ids]).order_by("pk"),
+                    chunk_size=chunk_size,
+                )
+                self.filter(id__in=[id for id, _ in ids]).delete()
+        return len(ids)
+
+
+class PasswordResetRequest(models.Model):
+    """
+    User queued for a password reset by the admin action, processed by the
+    ``reset_passwords`` command so large selections survive restarts.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    requested_on = models.DateTimeField(auto_now_add=True)
+
+    objects = PasswordResetRequestManager()
+
+
+class RefreshToken(models.Model):
+    """
+    Refresh token issued alongside an access token. Only an HMAC digest of
+    the token is stored, a token is revoked when it's rotated. Expired rows
+    are deleted by the ``prune_tokens`` command.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="refresh_tokens")
+    digest = models.CharField(max_length=64, unique=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    expires_on = models.DateTimeField()
+    revoked_on = models.DateTimeField(null=True, blank=True)
+
+
+class RevokedToken(models.Model):
+    """
+    Access token revoked before its expiry, identified by its ``jti`` claim.
+    Expired rows are deleted by the ``prune_tokens`` command.
+    """
+    jti = models.CharField(max_length=64, unique=True)
+    expires_on = models.DateTimeField()
+    revoked_on = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,101 @@
+import threading
+from datetime import timedelta
+from time import monotonic
+from django.conf import settings
+from django.utils import timezone
+from .bloom import BloomFilter
+from .models import RevokedToken
+
+
+# Revocations are loaded by their revoked_on timestamp, the overlap covers
+# rows whose transaction committed a while after they were timestamped.
+SYNC_OVERLAP = timedelta(seconds=30)
+
+
+class RevocationList:
+    """
+    Process-local view of ``RevokedToken``. A Bloom filter of revoked
+    ``jti`` claims answers the common not-revoked case without any I/O,
+    only filter hits are confirmed against the database. Every
+    ``sync_interval`` seconds the filter loads the rows revoked since the
+    previous sync, which is how revocations made by other processes reach
+    this one, and every ``rebuild_interval`` seconds it is rebuilt from the
+    unexpired rows to shed expired ones. ``capacity`` should comfortably
+    exceed the number of unexpired revocations.
+    """
+
+    def __init__(self, capacity=100_000, error_rate=0.001, sync_interval=5, rebuild_interval=3600):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._synced_from = None
+        self._last_sync = None
+        self._last_rebuild = None
+        self._lock = threading.Lock()
+
+    def _start_sync(self):
+        now = monotonic()
+        with self._lock:
+            if self._last_sync is not None and now - self._last_sync < self.sync_interval:
+                return None
+            self._last_sync = now
+        rebuild = (
+            self._synced_from is None or self._bloom.count >= self.capacity or
+            now - self._last_rebuild >= self.rebuild_interval
+        )
+        started = timezone.now()
+        revoked = RevokedToken.objects.filter(expires_on__gt=started)
+        if not rebuild:
+            revoked = revoked.filter(revoked_on__gte=self._synced_from - SYNC_OVERLAP)
+        return revoked.values_list("jti", flat=True), rebuild, started
+
+    def _finish_sync(self, jtis, rebuild, started):
+        if rebuild:
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            self._last_rebuild = monotonic()
+        else:
+            bloom = self._bloom
+        for jti in jtis:
+            bloom.add(jti)
+        self._bloom = bloom
+        self._synced_from = started
+
+    def sync(self):
+        """Catch up with the database if a sync is due."""
+        pending = self._start_sync()
+        if pending is not None:
+            jtis, rebuild, started = pending
+            self._finish_sync(list(jtis), rebuild, started)
+
+    async def async_sync(self):
+        """Async version of ``sync()``."""
+        pending = self._start_sync()
+        if pending is not None:
+            jtis, rebuild, started = pending
+            self._finish_sync([jti async for jti in jtis], rebuild, started)
+
+    def is_revoked(self, jti):
+        self.sync()
+        if jti not in self._bloom:
+            return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    async def ais_revoked(self, jti):
+        """Async version of ``is_revoked()``."""
+        await self.async_sync()
+        if jti not in self._bloom:
+            return False
+        return await RevokedToken.objects.filter(jti=jti).aexists()
+
+    def revoke(self, jti, expires_on):
+        RevokedToken.objects.get_or_create(jti=jti, defaults={"expires_on": expires_on})
+        self._bloom.add(jti)
+
+
+revocation_list = RevocationList(
+    capacity=getattr(settings, "MEMBERSHIP_REVOCATION_CAPACITY", 100_000),
+    sync_interval=getattr(settings, "MEMBERSHIP_REVOCATION_SYNC_INTERVAL", 5),
+    rebuild_interval=getattr(settings, "MEMBERSHIP_REVOCATION_REBUILD_INTERVAL", 3600),
+)
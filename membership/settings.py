@@ -17,6 +17,8 @@ ALLOWED_HOSTS = []
 
 AUTH_USER_MODEL = "membership.User"
 
+AUTHENTICATION_BACKENDS = ["membership.backends.CachedModelBackend"]
+
 # Application definition
 
 INSTALLED_APPS = [
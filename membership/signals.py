@@ -0,0 +1,89 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.contrib.auth.models import Group
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+from django.utils import timezone
+from .activity import activity_tracker
+from .auth import user_cache, token_cache, remember_token_version, forget_token_version
+from .conditional import bump_user_version, forget_user_version
+from .backends import bump_group_permission_version, bump_user_permission_versions
+from .keys import clear_key_set
+from .metrics import registry as metrics_registry
+from .models import User, EmailTemplate
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_cache(sender, instance, **kwargs):
+    user_cache.delete(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def update_token_version(sender, instance, **kwargs):
+    remember_token_version(instance)
+    bump_user_version(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def delete_token_version(sender, instance, **kwargs):
+    forget_token_version(instance)
+    forget_user_version(instance.pk)
+
+
+@receiver(setting_changed)
+def clear_token_cache(setting, **kwargs):
+    if setting in ("SECRET_KEY", "MEMBERSHIP_TOKEN_SIGNING_KEYS"):
+        clear_key_set()
+        token_cache.clear()
+
+
+@receiver(setting_changed)
+def configure_metrics(setting, **kwargs):
+    if setting.startswith("MEMBERSHIP_METRICS"):
+        metrics_registry.configure()
+
+
+@receiver([post_save, post_delete], sender=EmailTemplate)
+def invalidate_compiled_email_templates(sender, **kwargs):
+    EmailTemplate.objects.invalidate_compiled()
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_permissions(sender, instance, **kwargs):
+    # is_active and is_superuser decide which permissions apply.
+    bump_user_permission_versions([instance.pk])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_changed_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        bump_user_permission_versions([instance.pk])
+    elif pk_set is not None:
+        bump_user_permission_versions(pk_set)
+    else:
+        # Cleared from the group or permission side, the users are unknown.
+        bump_group_permission_version()
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_permissions(sender, action, **kwargs):
+    if action.startswith("post_"):
+        bump_group_permission_version()
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_deleted_group_permissions(sender, **kwargs):
+    bump_group_permission_version()
+
+
+# Replace Django's update_last_login, which writes the user row right away.
+user_logged_in.disconnect(dispatch_uid="update_last_login")
+
+
+@receiver(user_logged_in)
+def record_login(sender, user, **kwargs):
+    user.last_login = timezone.now()
+    activity_tracker.record_login(user.pk, user.last_login)
@@ -1,19 +1,56 @@
+import os
+import time
+import asyncio
+import json
+import tempfile
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from asgiref.sync import async_to_sync, sync_to_async
+from io import StringIO
+from datetime import timedelta
 from textwrap import dedent
-from django.test import TestCase
+from unittest import mock
+from django.test import Client, TestCase, override_settings
 from django.core import mail
+from django.db import connection, transaction, DatabaseError, IntegrityError
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.utils import timezone
+from django.core.management import call_command
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service as ChromeService
 
-from .models import User, EmailTemplate
+from .auth import (
+    BearerAuthChannelsMiddleware, TokenUser, aget_user, create_token, decode_token, read_claims,
+    revoke_token, token_cache, user_cache,
+)
+from .activity import activity_tracker
+from .hashers import hashing_executor
+from .metrics import registry
+from .revocation import RevocationList, revocation_list
+from .connections import ConnectionRegistry, CLOSE_UNAUTHORIZED
+from .verify import mount_token_verification
+from .models import User, EmailTemplate, PasswordResetRequest, RefreshToken, RevokedToken, SystemEmail
 
 
 class BaseTestCase(TestCase):
 
     def setUp(self):
         super().setUp()
+        # Keep periodic revocation list syncs from adding queries mid-test.
+        patcher = mock.patch.object(revocation_list, "sync_interval", 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        revocation_list.sync()
+        # Flush activity explicitly instead of from the background thread.
+        patcher = mock.patch.object(activity_tracker, "flush_interval", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(activity_tracker.clear)
         self.extra = {}
         self.user = User.objects.create_user(
             email='lex@damoti.com', password='pass',
@@ -69,6 +106,556 @@ class APITests(BaseTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"username": "lex"})
 
+    def test_account_etag(self):
+        async_to_sync(self.login)("lex", "pass")
+        response = async_to_sync(self.aget)("/api/account")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        with self.assertNumQueries(0):
+            response = async_to_sync(self.aget)("/api/account", headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        response = async_to_sync(self.aget)(
+            "/api/account", headers={"if-modified-since": response.headers["Last-Modified"]}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # saving the user changes the version
+        self.user.first_name = "Lex"
+        self.user.save()
+        response = async_to_sync(self.aget)("/api/account", headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    async def test_list_users(self):
+        await self.login("lex", "pass")
+        response = await self.aget("/api/users")
+        self.assertEqual(response.status_code, 403)
+
+        self.user.is_staff = True
+        await self.user.asave()
+        joined = timezone.now()
+        for name in ("Otto", "otis", "ada"):
+            await User.objects.acreate(username=name, email=f"{name}@example.com", date_joined=joined)
+        await self.login("lex", "pass")
+
+        usernames, cursor = [], None
+        while True:
+            response = await self.aget("/api/users", {"limit": 2, **({"cursor": cursor} if cursor else {})})
+            page = response.json()
+            usernames += [item["username"] for item in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(usernames, ["lex", "Otto", "otis", "ada"])
+
+        response = await self.aget("/api/users", {"search": "OT"})
+        self.assertEqual([item["username"] for item in response.json()["items"]], ["Otto", "otis"])
+        response = await self.aget("/api/users", {"search": "ada@ex"})
+        self.assertEqual([item["email"] for item in response.json()["items"]], ["ada@example.com"])
+
+        response = await self.aget("/api/users", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 422)
+
+    async def test_refresh(self):
+        status_code, json = await self.login("lex", "pass")
+        refresh_token = json["refresh_token"]
+
+        response = await self.apost("/api/refresh", data={"refresh_token": refresh_token})
+        self.assertEqual(response.status_code, 200)
+        rotated = response.json()["refresh_token"]
+        self.assertNotEqual(rotated, refresh_token)
+        self.extra["authorization"] = f"Bearer {response.json()['token']}"
+        response = await self.aget("/api/account")
+        self.assertEqual(response.json(), {"username": "lex"})
+
+        # replaying a rotated token revokes the whole family
+        response = await self.apost("/api/refresh", data={"refresh_token": refresh_token})
+        self.assertEqual(response.status_code, 422)
+        response = await self.apost("/api/refresh", data={"refresh_token": rotated})
+        self.assertEqual(response.status_code, 422)
+
+    async def test_login_rejected_when_hashing_pool_is_full(self):
+        with mock.patch.object(hashing_executor, "max_pending", -hashing_executor.max_workers):
+            status_code, json = await self.login("lex", "pass")
+        self.assertEqual(status_code, 503)
+        self.assertEqual(hashing_executor.stats()["rejected"], 1)
+
+    def test_user_cache(self):
+        user_cache.clear()
+        headers = {"authorization": f"Bearer {create_token(self.user)}"}
+        with self.assertNumQueries(1):
+            self.client.get("/api/account", headers=headers)
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/account", headers=headers)
+        self.assertEqual(response.json(), {"username": "lex"})
+        self.assertEqual(user_cache.stats()["hits"], 1)
+
+        # saving the user invalidates the cached copy
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get("/api/account", headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(MEMBERSHIP_TOKEN_CLAIMS=True)
+    def test_claims_mode(self):
+        user_cache.clear()
+        headers = {"authorization": f"Bearer {create_token(self.user)}"}
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/account", headers=headers)
+        self.assertEqual(response.json(), {"username": "lex"})
+
+        # changing a claim field makes outstanding tokens stale
+        self.user.username = "lexb"
+        self.user.save()
+        self.assertEqual(self.user.token_version, 1)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/account", headers=headers)
+        self.assertEqual(response.json(), {"username": "lexb"})
+
+        # saving without touching claim fields keeps the version
+        self.user.first_name = "Lex"
+        self.user.save()
+        self.assertEqual(self.user.token_version, 1)
+
+    async def test_revoke_token(self):
+        await self.login("lex", "pass")
+        token = self.extra["authorization"][len("Bearer "):]
+        await sync_to_async(revoke_token)(token)
+        response = await self.aget("/api/account")
+        self.assertEqual(response.status_code, 401)
+
+        # other processes pick the revocation up on their next sync
+        other = RevocationList(sync_interval=0)
+        self.assertTrue(await other.ais_revoked(decode_token(token)["jti"]))
+        self.assertFalse(await other.ais_revoked("not-revoked"))
+        # rows inside the sync overlap are loaded again but counted once
+        count = other._bloom.count
+        await other.ais_revoked("not-revoked")
+        self.assertEqual(other._bloom.count, count)
+
+    def test_asymmetric_signing(self):
+        def pem(key):
+            return key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+            ).decode()
+
+        def public_pem(key):
+            return key.public_key().public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode()
+
+        old_key, new_key = Ed25519PrivateKey.generate(), Ed25519PrivateKey.generate()
+        with self.settings(MEMBERSHIP_TOKEN_SIGNING_KEYS=[
+            {"kid": "old", "algorithm": "EdDSA", "private_key": pem(old_key)},
+        ]):
+            old_token = create_token(self.user)
+        with self.settings(MEMBERSHIP_TOKEN_SIGNING_KEYS=[
+            {"kid": "new", "algorithm": "EdDSA", "private_key": pem(new_key)},
+            {"kid": "old", "algorithm": "EdDSA", "public_key": public_pem(old_key)},
+        ]):
+            token = create_token(self.user)
+            self.assertEqual(jwt.get_unverified_header(token)["kid"], "new")
+            self.assertEqual(read_claims(token)["id"], self.user.id)
+            self.assertEqual(read_claims(old_token)["id"], self.user.id)
+            with self.assertRaises(jwt.InvalidTokenError):
+                read_claims(jwt.encode({"id": 1}, "secret", algorithm="HS256"))
+
+            response = self.client.get("/api/.well-known/jwks.json")
+            self.assertEqual(response["Cache-Control"], "public, max-age=3600")
+            keys = {jwk["kid"]: jwt.PyJWK(jwk) for jwk in response.json()["keys"]}
+            self.assertEqual(sorted(keys), ["new", "old"])
+            claims = jwt.decode(token, keys["new"].key, algorithms=["EdDSA"])
+            self.assertEqual(claims["id"], self.user.id)
+
+    def test_token_cache(self):
+        token_cache.clear()
+        token = create_token(self.user)
+        self.assertEqual(read_claims(token)["id"], self.user.id)
+        self.assertEqual(read_claims(token.encode())["id"], self.user.id)
+        self.assertEqual(token_cache.stats()["hits"], 1)
+
+        # cached claims are not trusted under a different signing key
+        with self.settings(SECRET_KEY="another-secret-key"):
+            with self.assertRaises(jwt.InvalidSignatureError):
+                read_claims(token)
+
+    async def test_metrics(self):
+        response = await self.aget("/api/metrics")
+        self.assertEqual(response.status_code, 404)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(MEMBERSHIP_METRICS=True, MEMBERSHIP_METRICS_DIR=directory):
+            registry.clear()
+            self.addCleanup(registry.clear)
+            await self.login("lex", "pass")
+            await self.aget("/api/account")
+            # samples flushed by another worker are added to our own
+            with open(os.path.join(directory, "membership-1-1.json"), "w") as file:
+                json.dump({"operations": {"login": {
+                    "calls": 2, "errors": 1, "queries": 4, "duration_sum": 0.5,
+                    "buckets": [0] * 9 + [2, 0, 0, 0, 0],
+                }}, "stats": {}}, file)
+            # an exited worker keeps its counters but not its gauges
+            with open(os.path.join(directory, "membership-1-0.json"), "w") as file:
+                json.dump({"operations": {}, "stats": {
+                    "token_cache": {"hits_total": 1000, "misses_total": 0, "size": 1000},
+                }}, file)
+            response = await self.aget("/api/metrics")
+            with self.settings(MEMBERSHIP_METRICS_TOKEN="secret"):
+                unauthorized = await self.async_client.get("/api/metrics")
+                authorized = await self.async_client.get("/api/metrics", headers={"Authorization": "Bearer secret"})
+
+        self.assertEqual(response.status_code, 200)
+        metrics = response.content.decode()
+        self.assertIn('membership_calls_total{operation="login"} 3', metrics)
+        self.assertIn('membership_errors_total{operation="login"} 1', metrics)
+        self.assertIn('membership_calls_total{operation="authenticate"} 1', metrics)
+        self.assertIn('membership_duration_seconds_count{operation="login"} 3', metrics)
+        self.assertIn('membership_duration_seconds_bucket{operation="login",le="+Inf"} 3', metrics)
+        self.assertIn("membership_hashing_completed_total", metrics)
+        login_queries = int(metrics.split('membership_queries_total{operation="login"} ')[1].split()[0])
+        self.assertGreater(login_queries, 4)
+        hits = int(metrics.split("\nmembership_token_cache_hits_total ")[1].split()[0])
+        self.assertGreaterEqual(hits, 1000)
+        size = int(metrics.split("\nmembership_token_cache_size ")[1].split()[0])
+        self.assertLess(size, 1000)
+        self.assertEqual(unauthorized.status_code, 401)
+        self.assertEqual(authorized.status_code, 200)
+
+    def test_activity_is_flushed_in_bulk(self):
+        async_to_sync(self.login)("lex", "pass")
+        other = User.objects.create_user(email="other@damoti.com", password="pass")
+        async_to_sync(self.aget)("/api/account")
+        activity_tracker.record_seen(other.pk)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertIsNone(user.last_login)
+        self.assertIsNone(user.last_seen)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(activity_tracker.flush(), 2)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertIsNotNone(user.last_login)
+        self.assertGreaterEqual(user.last_seen, user.last_login)
+        other = User.objects.get(pk=other.pk)
+        self.assertIsNone(other.last_login)
+        self.assertIsNotNone(other.last_seen)
+
+
+class ChannelsTests(BaseTestCase):
+
+    async def connect(self, headers):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = BearerAuthChannelsMiddleware(inner)
+        await middleware({"type": "websocket", "user": AnonymousUser(), "headers": headers}, None, None)
+        return scopes[0]["user"]
+
+    async def test_lazy_user(self):
+        user_cache.clear()
+        token = create_token(self.user).encode()
+        user = await self.connect([(b"host", b"localhost"), (b"authorization", b"Bearer " + token)])
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(user.id, self.user.id)
+        with self.assertRaises(AttributeError):
+            user.username
+        self.assertEqual((await user.aget()).username, "lex")
+        self.assertEqual(user.username, "lex")
+
+        user = await self.connect([(b"authorization", b"Bearer not-a-token")])
+        self.assertFalse(user.is_authenticated)
+
+    async def test_revalidate_connections(self):
+        other = await sync_to_async(User.objects.create_user)(email="bob@damoti.com")
+        closed = []
+
+        async def send(message):
+            closed.append(message)
+
+        registry = ConnectionRegistry(batch_size=1)
+        registry.register(self.user.id, time.time() + 60, send)
+        registry.register(other.id, time.time() + 60, send)
+        registry.register(self.user.id, time.time() - 1, send)
+        self.assertEqual(await registry.revalidate(), 1)
+
+        other.is_active = False
+        await other.asave()
+        self.assertEqual(await registry.revalidate(), 1)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(closed, [{"type": "websocket.close", "code": CLOSE_UNAUTHORIZED}] * 2)
+
+        # a failing send or database error doesn't stop the background task
+        async def broken_send(message):
+            raise OSError("socket closed")
+
+        registry = ConnectionRegistry(interval=0)
+        registry.register(other.id, None, broken_send)
+        registry.register(self.user.id, time.time() - 1, send)
+        with self.assertLogs("membership.connections", "WARNING"):
+            await asyncio.sleep(0.1)
+        self.assertEqual(len(registry), 0)
+        connection = registry.register(self.user.id, None, send)
+        with mock.patch.object(registry, "revalidate", side_effect=DatabaseError), \
+                self.assertLogs("membership.connections", "ERROR"):
+            await asyncio.sleep(0.1)
+        self.assertFalse(registry._task.done())
+        registry.unregister(connection)
+        await asyncio.sleep(0)
+
+    def test_token_verification_app(self):
+        async def django_app(scope, receive, send):
+            raise AssertionError("request should not reach Django")
+
+        app = mount_token_verification(django_app, "/auth/verify")
+
+        @async_to_sync
+        async def request(headers):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await app({"type": "http", "path": "/auth/verify", "headers": headers}, None, send)
+            return messages[0]["status"], dict(messages[0]["headers"])
+
+        token = create_token(self.user).encode()
+        with CaptureQueriesContext(connection) as queries:
+            status, headers = request([(b"authorization", b"Bearer " + token)])
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"x-user-id"], str(self.user.id).encode())
+        self.assertEqual(json.loads(headers[b"x-token-claims"])["id"], self.user.id)
+
+        status, headers = request([(b"authorization", b"Bearer bad-token")])
+        self.assertEqual(status, 401)
+
+    def test_user_lookups_are_coalesced(self):
+        user_cache.clear()
+
+        async def lookup():
+            return await asyncio.gather(*(aget_user(self.user.id) for _ in range(3)))
+
+        with CaptureQueriesContext(connection) as queries:
+            users = async_to_sync(lookup)()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual({user.username for user in users}, {"lex"})
+        self.assertEqual(len({id(user) for user in users}), 3)
+
+
+class ModelTests(BaseTestCase):
+
+    def test_set_username(self):
+        User.objects.create_user(email="lex@berezhny.com")
+        User.objects.create_user(email="lex@example.com")
+        self.assertEqual(
+            list(User.objects.order_by("id").values_list("username", flat=True)),
+            ["lex", "lex2", "lex3"]
+        )
+        user = User(email="lex@example.org")
+        with self.assertNumQueries(1):
+            self.assertEqual(user.set_username("lex"), "lex4")
+
+        # names merely sharing the prefix aren't loaded
+        User.objects.create_user(email="lexicon@example.com")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(User.objects.allocate_usernames(["lex"]), ["lex4"])
+        with connection.cursor() as cursor:
+            cursor.execute(queries[0]["sql"])
+            self.assertEqual(sorted(row[0] for row in cursor.fetchall()), ["lex", "lex2", "lex3"])
+
+    def test_case_insensitive_natural_key(self):
+        self.assertEqual(User.objects.get_by_natural_key("Lex@Damoti.com"), self.user)
+        self.assertEqual(User.objects.get_by_natural_key("LEX"), self.user)
+        self.assertEqual(async_to_sync(User.objects.aget_by_natural_key)("LEX@damoti.com"), self.user)
+
+        # usernames are allocated and emails enforced unique ignoring case
+        self.assertEqual(User.objects.create_user(email="Lex@example.com").username, "Lex2")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user(email="LEX@damoti.com")
+
+        # non-ASCII names are lowered by the database on both sides
+        user = User.objects.create_user(email="Élodie@example.com")
+        self.assertEqual(User.objects.get_by_natural_key("Élodie"), user)
+        self.assertEqual(User.objects.get_by_natural_key("Élodie@example.com"), user)
+        self.assertEqual(User.objects.create_user(email="Élodie@other.com").username, "Élodie2")
+        self.assertEqual(User.objects.allocate_usernames(["Élodie", "Élodie"]), ["Élodie3", "Élodie4"])
+        self.assertEqual(User.objects.filter_usernames(["Élodie"]).get(), user)
+        self.assertEqual(User.objects.search("Élodie@ex").get(), user)
+
+    def test_cached_permissions(self):
+        group = Group.objects.create(name="editors")
+        group.permissions.add(Permission.objects.get(codename="change_emailtemplate"))
+        self.user.groups.add(group)
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm("membership.change_emailtemplate"))
+
+        # fresh instances and token users read the permissions from the cache
+        user = User.objects.get(pk=self.user.pk)
+        token_user = TokenUser(self.user.pk, "lex", True, False)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm("membership.change_emailtemplate"))
+            self.assertFalse(user.has_perm("membership.delete_emailtemplate"))
+            self.assertTrue(token_user.has_module_perms("membership"))
+
+        # group permission edits are picked up by the next request
+        group.permissions.add(Permission.objects.get(codename="delete_emailtemplate"))
+        self.assertTrue(User.objects.get(pk=self.user.pk).has_perm("membership.delete_emailtemplate"))
+        self.user.groups.remove(group)
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_perm("membership.delete_emailtemplate"))
+
+    def test_create_user_retries_username_collision(self):
+        set_username = User.set_username
+        calls = []
+
+        def racy_set_username(user, username):
+            # the first allocation loses the race to an existing user
+            calls.append(username)
+            if len(calls) == 1:
+                user.username = "lex"
+                return "lex"
+            return set_username(user, username)
+
+        with mock.patch.object(User, "set_username", racy_set_username):
+            user = User.objects.create_user(email="lex@berezhny.com")
+        self.assertEqual(user.username, "lex2")
+        self.assertEqual(len(calls), 2)
+
+    def test_bulk_create_users(self):
+        created = User.objects.bulk_create_users((
+            {"email": f"lex@example{i}.com", "password": "pass"} for i in range(5)
+        ), batch_size=2, workers=1)
+        self.assertEqual(created, 5)
+        users = User.objects.filter(email__startswith="lex@example").order_by("username")
+        self.assertEqual(
+            [user.username for user in users], ["lex2", "lex3", "lex4", "lex5", "lex6"]
+        )
+        self.assertTrue(users[0].check_password("pass"))
+
+    def test_import_users(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.jsonl")
+            with open(path, "w") as file:
+                for email in ["user0@example.com", "user1@example.com", "Élodie@example.com", "user3@example.com"]:
+                    file.write(json.dumps({"email": email, "first_name": "Bob"}) + "\n")
+            # pretend an earlier run got through the first record, and died
+            # after committing the next two but before recording them
+            with open(f"{path}.checkpoint", "w") as file:
+                file.write("1")
+            User.objects.create_user(email="User1@example.com", first_name="Bob")
+            User.objects.create_user(email="Élodie@example.com", first_name="Bob")
+            call_command("import_users", path, workers=1, stdout=StringIO())
+            self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+        self.assertEqual(
+            list(User.objects.filter(first_name="Bob").order_by("id").values_list("username", flat=True)),
+            ["User1", "Élodie", "user3"]
+        )
+
+    def test_system_email_retries(self):
+        SystemEmail.objects.create(name="test", subject="Hi", text="Hello", recipient=self.user)
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=OSError):
+            self.assertEqual(SystemEmail.objects.deliver_pending(), 1)
+        email = SystemEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (SystemEmail.PENDING, 1))
+        self.assertIn("OSError", email.last_error)
+        # not due again until the backoff has passed
+        self.assertEqual(SystemEmail.objects.deliver_pending(), 0)
+        SystemEmail.objects.update(next_attempt_on=email.created_on)
+        self.assertEqual(SystemEmail.objects.deliver_pending(), 1)
+        email = SystemEmail.objects.get()
+        self.assertEqual((email.status, email.text), (SystemEmail.SENT, ""))
+        self.assertEqual(mail.outbox[0].to, ["lex@damoti.com"])
+
+    def test_system_email_connection_failure(self):
+        SystemEmail.objects.create(name="test", subject="Hi", text="Hello", recipient=self.user)
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.open", side_effect=ConnectionRefusedError
+        ) as open_connection:
+            call_command("send_system_emails", once=True, stdout=StringIO())
+        open_connection.assert_called_once()
+        email = SystemEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (SystemEmail.PENDING, 1))
+        self.assertIn("ConnectionRefusedError", email.last_error)
+
+        # giving up scrubs the text too, it may contain a password
+        with self.settings(MEMBERSHIP_EMAIL_MAX_ATTEMPTS=2), mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.open", side_effect=ConnectionRefusedError
+        ):
+            SystemEmail.objects.update(next_attempt_on=timezone.now())
+            call_command("send_system_emails", once=True, stdout=StringIO())
+        email = SystemEmail.objects.get()
+        self.assertEqual((email.status, email.text), (SystemEmail.FAILED, ""))
+
+        # an empty outbox doesn't connect at all
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.open") as open_connection:
+            call_command("send_system_emails", once=True, stdout=StringIO())
+        open_connection.assert_not_called()
+
+    def test_compiled_email_template(self):
+        template = EmailTemplate.objects.create(
+            name="greeting", subject="Hi {user.username}", body="Hello {user.email}, {note}",
+        )
+        EmailTemplate.objects.get_compiled("greeting")
+        with self.assertNumQueries(0):
+            compiled = EmailTemplate.objects.get_compiled("greeting")
+        other = User(username="bob", email="bob@damoti.com")
+        self.assertEqual(compiled.render_many([self.user, other], note="bye"), [
+            ("Hi lex", "Hello lex@damoti.com, bye"), ("Hi bob", "Hello bob@damoti.com, bye"),
+        ])
+
+        # saving a template invalidates the compiled copies
+        template.subject = "Hey {user.username}"
+        template.save()
+        self.assertEqual(EmailTemplate.objects.get_compiled("greeting").render(other, note="")[0], "Hey bob")
+
+        # edits made by other processes are picked up once the version expires
+        with self.settings(MEMBERSHIP_VERSION_TTL=0.1):
+            EmailTemplate.objects.invalidate_compiled()
+            EmailTemplate.objects.get_compiled("greeting")
+            EmailTemplate.objects.filter(pk=template.pk).update(subject="Yo {user.username}")
+            time.sleep(0.2)
+            self.assertEqual(EmailTemplate.objects.get_compiled("greeting").render(other, note="")[0], "Yo bob")
+
+        with self.assertRaises(ValueError):
+            EmailTemplate(name="broken", subject="{0}", body="").compile()
+
+    def test_prune_system_emails(self):
+        old = timezone.now() - timedelta(days=40)
+        for status, sent_on in [
+            (SystemEmail.SENT, old), (SystemEmail.SENT, timezone.now()),
+            (SystemEmail.PENDING, None), (SystemEmail.FAILED, None),
+        ]:
+            SystemEmail.objects.create(
+                name="test", text="", recipient=self.user, status=status, sent_on=sent_on,
+            )
+        SystemEmail.objects.filter(status=SystemEmail.FAILED).update(created_on=old)
+        call_command("prune_system_emails", older_than=30, chunk_size=2, sleep=0, stdout=StringIO())
+        self.assertEqual(
+            sorted(SystemEmail.objects.values_list("status", flat=True)),
+            [SystemEmail.PENDING, SystemEmail.SENT]
+        )
+
+    def test_prune_tokens(self):
+        now = timezone.now()
+        for expires_on, revoked_on in [
+            (now - timedelta(days=1), None), (now - timedelta(days=1), now - timedelta(days=2)),
+            (now + timedelta(days=1), None), (now + timedelta(days=1), now),
+        ]:
+            RefreshToken.objects.create(
+                user=self.user, digest=f"{expires_on}-{revoked_on}", expires_on=expires_on,
+                revoked_on=revoked_on,
+            )
+        RevokedToken.objects.create(jti="expired", expires_on=now - timedelta(minutes=1))
+        RevokedToken.objects.create(jti="active", expires_on=now + timedelta(minutes=1))
+        call_command("prune_tokens", chunk_size=2, sleep=0, stdout=StringIO())
+        # revoked tokens are kept until they expire, for reuse detection
+        self.assertEqual(RefreshToken.objects.filter(expires_on__gt=now).count(), 2)
+        self.assertEqual(RefreshToken.objects.count(), 2)
+        self.assertEqual(list(RevokedToken.objects.values_list("jti", flat=True)), ["active"])
+
 
 class ViewTests(BaseTestCase):
 
@@ -99,6 +686,9 @@ class ViewTests(BaseTestCase):
         # valid login using username
         response = self.client.post("/login", {"username": "lex", "password": "pass", "next": "/account"})
         self.assertRedirects(response, "/account")
+        self.assertIsNone(User.objects.get(pk=self.user.pk).last_login)
+        activity_tracker.flush()
+        self.assertIsNotNone(User.objects.get(pk=self.user.pk).last_login)
 
         # logout
         response = self.client.post("/logout")
@@ -115,6 +705,54 @@ class ViewTests(BaseTestCase):
         response = self.client.get("/account")
         self.assertInResponse("lex@damoti.com", response)
 
+    @override_settings(MIDDLEWARE=[
+        "django.middleware.security.SecurityMiddleware",
+        "django.middleware.common.CommonMiddleware",
+        "django.middleware.csrf.CsrfViewMiddleware",
+        "membership.middleware.TokenCookieMiddleware",
+        "django.contrib.messages.middleware.MessageMiddleware",
+    ])
+    def test_token_cookie_login_flow(self):
+        response = self.client.post("/login", {"username": "lex", "password": "pass", "next": "/account"})
+        self.assertRedirects(response, "/account", fetch_redirect_response=False)
+        token = response.cookies["membership_token"]
+        self.assertTrue(token["httponly"])
+        self.assertEqual(read_claims(token.value)["id"], self.user.id)
+
+        # the cookie alone identifies the user, no session row is involved
+        self.client.get("/account")
+        with self.assertNumQueries(0):
+            response = self.client.get("/account")
+        self.assertInResponse("lex@damoti.com", response)
+
+        # changing the password swaps the cookie for a new token
+        response = self.client.post("/password_change/", {
+            "old_password": "pass", "new_password1": "n3w-Passw0rd", "new_password2": "n3w-Passw0rd",
+        })
+        self.assertRedirects(response, "/password_change/done/", fetch_redirect_response=False)
+        self.assertNotEqual(self.client.cookies["membership_token"].value, token.value)
+        with self.assertRaises(jwt.InvalidTokenError):
+            read_claims(token.value)
+
+        # the password change logged out every other device
+        other = Client()
+        other.post("/login", {"username": "lex", "password": "n3w-Passw0rd"})
+        self.assertEqual(other.get("/account").status_code, 200)
+        self.client.post("/password_change/", {
+            "old_password": "n3w-Passw0rd", "new_password1": "n3w3r-Passw0rd", "new_password2": "n3w3r-Passw0rd",
+        })
+        self.assertEqual(self.client.get("/account").status_code, 200)
+        response = other.get("/account")
+        self.assertRedirects(response, "/login?next=/account")
+
+        # logging out deletes the cookie and revokes its token
+        token = self.client.cookies["membership_token"].value
+        response = self.client.post("/logout")
+        self.assertEqual(response.cookies["membership_token"].value, "")
+        self.client.cookies["membership_token"] = token
+        response = self.client.get("/account")
+        self.assertRedirects(response, "/login?next=/account")
+
     def test_admin(self):
         self.user.is_staff = True
         self.user.is_superuser = True
@@ -144,12 +782,50 @@ class ViewTests(BaseTestCase):
             "first_name": "Lex", "last_name": "Berezhny",
         })
         self.assertRedirects(response, "/admin/membership/user/2/change/")
+        self.assertEqual(len(mail.outbox), 0)
+        call_command("send_system_emails", once=True, stdout=StringIO())
+        self.assertEqual(SystemEmail.objects.get().status, SystemEmail.SENT)
         email = mail.outbox[0]
         self.assertEqual(email.subject, "Welcome to membership app!")
         self.assertEqual(
             email.body, "Lex Berezhny,\nusername: lex@berezhny.com\npassword: FooPass123\n"
         )
 
+    def test_admin_reset_password(self):
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        EmailTemplate.objects.create(
+            name=EmailTemplate.objects.WELCOME_EMAIL_NAME,
+            subject="New password", body="password: {password}",
+        )
+        other = User.objects.create_user(email="bob@damoti.com", password="pass")
+        response = self.client.post("/admin/membership/user/", {
+            "action": "reset_password", "_selected_action": [self.user.pk, other.pk],
+        })
+        self.assertRedirects(response, "/admin/membership/user/", fetch_redirect_response=False)
+        call_command("send_system_emails", once=True, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        for email in mail.outbox:
+            user = User.objects.get(email=email.to[0])
+            self.assertTrue(user.check_password(email.body[len("password: "):]))
+
+        # large selections are queued for the reset_passwords worker
+        mail.outbox.clear()
+        self.user.refresh_from_db()
+        self.client.force_login(self.user)
+        with self.settings(MEMBERSHIP_RESET_PASSWORD_BACKGROUND_THRESHOLD=1):
+            response = self.client.post("/admin/membership/user/", {
+                "action": "reset_password", "_selected_action": [self.user.pk, other.pk],
+            })
+        self.assertRedirects(response, "/admin/membership/user/", fetch_redirect_response=False)
+        self.assertEqual(PasswordResetRequest.objects.count(), 2)
+        call_command("reset_passwords", once=True, stdout=StringIO())
+        self.assertFalse(PasswordResetRequest.objects.exists())
+        call_command("send_system_emails", once=True, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+
 
 class SeleniumTests(StaticLiveServerTestCase):
 
@@ -0,0 +1,49 @@
+import json
+import jwt
+from django.conf import settings
+from .auth import aread_claims
+
+
+class TokenVerificationApp:
+    """
+    Bare ASGI app answering reverse proxy ``auth_request`` subrequests.
+    Responds 200 with ``X-User-Id`` and ``X-Token-Claims`` (compact JSON)
+    headers when the bearer token is valid and 401 otherwise, without going
+    through Django's middleware, sessions or the user table. Only revocation
+    Bloom filter hits and the periodic revocation sync reach the database.
+    """
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope["headers"])
+        authorization = headers.get(b"authorization", b"")
+        status, response_headers = 401, [(b"www-authenticate", b"Bearer")]
+        if authorization[:7].lower() == b"bearer ":
+            try:
+                claims = await aread_claims(authorization[7:])
+            except jwt.InvalidTokenError:
+                pass
+            else:
+                status, response_headers = 200, [
+                    (b"x-user-id", str(claims["id"]).encode()),
+                    (b"x-token-claims", json.dumps(claims, separators=(",", ":")).encode()),
+                ]
+        response_headers.append((b"content-length", b"0"))
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def mount_token_verification(application, path=None):
+    """
+    Wrap ``application`` so that HTTP requests for ``path`` (defaults to
+    ``MEMBERSHIP_VERIFY_PATH``, ``/auth/verify``) are answered by
+    ``TokenVerificationApp`` and everything else is passed through.
+    """
+    path = path or getattr(settings, "MEMBERSHIP_VERIFY_PATH", "/auth/verify")
+    verify = TokenVerificationApp()
+
+    async def router(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == path:
+            return await verify(scope, receive, send)
+        return await application(scope, receive, send)
+
+    return router
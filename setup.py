@@ -10,13 +10,17 @@ setup(
     keywords='django,user,membership,account,subscription',
     install_requires=[
         "django>=4.2",
-        "django-ninja>=0.21.0",
+        "django-ninja>=1.0",
         "channels>=4.0.0",
         "pyjwt>=2.6.0",
         "crispy-bootstrap5>=0.7",
     ],
     extras_require={
+        "crypto": [
+            "pyjwt[crypto]",
+        ],
         "development": [
+            "pyjwt[crypto]",
             "daphne",
             "selenium",
             "webdriver-manager",